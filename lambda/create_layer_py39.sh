@@ -17,7 +17,6 @@ echo "依存ライブラリのインストール..."
 python3.9 -m pip install --target ~/lambda-layer/python \
   boto3==1.26.0 \
   rawpy==0.17.0 \
-  imageio==2.25.1 \
   pillow==9.5.0
 
 # zipファイルの作成
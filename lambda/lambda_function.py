@@ -7,11 +7,17 @@ Python 3.13 + rawpy対応版
 import json
 import boto3
 import rawpy
-import imageio
 import os
+import io
+import re
+import shutil
+import tempfile
 import logging
 from datetime import datetime
-from typing import Dict, Any, Optional, List, Tuple
+from urllib.parse import unquote_plus
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, List, Tuple, BinaryIO
+from PIL import Image
 
 # ロギング設定
 logger = logging.getLogger()
@@ -20,8 +26,18 @@ logger.setLevel(logging.INFO)
 # S3クライアント初期化
 s3_client = boto3.client('s3')
 
-# サポートするRAW拡張子のリスト
-RAW_EXTENSIONS = [
+# S3からのストリーミングコピー単位(1MB)
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# 同時に処理するレコード数の上限（Lambdaのメモリ量に合わせて調整）
+MAX_RECORD_WORKERS = int(os.environ.get('MAX_RECORD_WORKERS', '4'))
+
+# サムネイルの最大サイズ
+THUMBNAIL_MAX_WIDTH = 1200
+THUMBNAIL_MAX_HEIGHT = 1200
+
+# サポートするRAW拡張子のセット
+RAW_EXTENSIONS = frozenset({
     '.arw',  # Sony
     '.cr2', '.cr3',  # Canon
     '.dng',  # Adobe DNG
@@ -43,62 +59,40 @@ RAW_EXTENSIONS = [
     '.erf',  # Epson
     '.mos',  # Leaf
     '.rwz',  # Rawzor
-]
+})
 
-# サポートするJPG拡張子のリスト
-JPG_EXTENSIONS = [
+# サポートするJPG拡張子のセット
+JPG_EXTENSIONS = frozenset({
     '.jpg',
     '.jpeg',
-]
+})
 
-def get_file_extension(filename: str) -> str:
-    """ファイルの拡張子を取得"""
-    return os.path.splitext(filename)[1].lower()
+# 処理対象となる全拡張子
+SUPPORTED_EXTENSIONS = RAW_EXTENSIONS | JPG_EXTENSIONS
 
-def is_raw_file(filename: str) -> bool:
-    """RAWファイルかどうかを判定"""
-    extension = get_file_extension(filename)
-    return extension in RAW_EXTENSIONS
-
-def is_jpg_file(filename: str) -> bool:
-    """JPGファイルかどうかを判定"""
-    extension = get_file_extension(filename)
-    return extension in JPG_EXTENSIONS
+# S3パス解析用パターン: user/userId/filetype/year/month/day/filename.ext
+PATH_INFO_PATTERN = re.compile(
+    r'^[^/]*/(?P<user_id>[^/]*)/(?P<file_type>[^/]*)/(?P<year>\d+)/(?P<month>\d+)/(?P<day>\d+)/'
+)
 
 def extract_path_info(key: str) -> Optional[Dict[str, str]]:
     """S3パスからユーザーIDと日付情報を抽出"""
     # パスの例: user/abc123/raw/2023/04/15/file.x3f
     # または: user/abc123/jpg/2023/04/15/file.jpg
-    path_parts = key.split('/')
-    if len(path_parts) < 7:  # 必要な階層が足りない
+    match = PATH_INFO_PATTERN.match(key)
+    if not match:  # 必要な階層が足りない、または日付部分が数値ではない
         logger.warning(f"無効なパス形式: {key}")
         return None
 
-    try:
-        # user/userId/filetype/year/month/day/filename.ext
-        user_id = path_parts[1]
-        file_type = path_parts[2]  # raw または jpg
-        year = path_parts[3]
-        month = path_parts[4]
-        day = path_parts[5]
-
-        # 数値形式の検証
-        if not (year.isdigit() and month.isdigit() and day.isdigit()):
-            logger.warning(f"パスの日付部分が数値ではありません: {key}")
-            return None
-
-        return {
-            "user_id": user_id,
-            "file_type": file_type,
-            "year": year,
-            "month": month.zfill(2),  # 1桁の場合は0埋め
-            "day": day.zfill(2)  # 1桁の場合は0埋め
-        }
-    except Exception as e:
-        logger.error(f"パス情報抽出エラー: {e}")
-        return None
+    return {
+        "user_id": match.group('user_id'),
+        "file_type": match.group('file_type'),  # raw または jpg
+        "year": match.group('year'),
+        "month": match.group('month').zfill(2),  # 1桁の場合は0埋め
+        "day": match.group('day').zfill(2)  # 1桁の場合は0埋め
+    }
 
-def generate_thumbnail_path(source_key: str, filename: str) -> Optional[str]:
+def generate_thumbnail_path(source_key: str, stem: str) -> Optional[str]:
     """サムネイル保存先のS3パスを生成"""
     path_info = extract_path_info(source_key)
     if not path_info:
@@ -113,8 +107,8 @@ def generate_thumbnail_path(source_key: str, filename: str) -> Optional[str]:
         logger.warning(f"サポートされていないファイルタイプ: {path_info['file_type']}")
         return None
 
-    # サムネイル用のファイル名を生成（拡張子をjpgに変更）
-    thumbnail_filename = os.path.splitext(filename)[0] + "_thumb.jpg"
+    # サムネイル用のファイル名を生成（拡張子を除いたファイル名 + _thumb.jpg）
+    thumbnail_filename = stem + "_thumb.jpg"
 
     # サムネイル保存先のパスを生成
     return f"user/{path_info['user_id']}/{thumbnail_dir}/{path_info['year']}/{path_info['month']}/{path_info['day']}/{thumbnail_filename}"
@@ -128,15 +122,25 @@ def process_raw_file(raw_path: str, thumb_path: str) -> bool:
             # まず埋め込みサムネイルの取得を試みる
             try:
                 thumb = raw.extract_thumb()
-                if thumb.format == 'jpeg':
+                if thumb.format == rawpy.ThumbFormat.JPEG:
                     # JPEGサムネイルがある場合
                     logger.info("埋め込みJPEGサムネイル抽出成功")
-                    with open(thumb_path, 'wb') as f:
-                        f.write(thumb.data)
+                    with Image.open(io.BytesIO(thumb.data)) as img:
+                        if img.width <= THUMBNAIL_MAX_WIDTH and img.height <= THUMBNAIL_MAX_HEIGHT:
+                            # 最大サイズ以内ならデコードせずそのまま保存
+                            with open(thumb_path, 'wb') as f:
+                                f.write(thumb.data)
+                        else:
+                            save_thumbnail(img, thumb_path)
+                    return True
+                elif thumb.format == rawpy.ThumbFormat.BITMAP:
+                    # ビットマップ形式の場合はデモザイク処理をせずJPEGに変換
+                    logger.info("埋め込みビットマップサムネイル抽出成功")
+                    save_thumbnail(Image.fromarray(thumb.data), thumb_path)
                     return True
                 else:
-                    # 埋め込みサムネイルがあるがJPEGではない場合
-                    logger.info(f"埋め込みサムネイルはJPEG形式ではありません: {thumb.format}")
+                    # 埋め込みサムネイルがあるが未対応の形式の場合
+                    logger.info(f"埋め込みサムネイルは未対応の形式です: {thumb.format}")
             except (rawpy.LibRawError, OSError) as e:
                 # サムネイル取得に失敗した場合
                 logger.info(f"埋め込みサムネイル抽出失敗: {e}")
@@ -156,8 +160,8 @@ def process_raw_file(raw_path: str, thumb_path: str) -> bool:
                 output_bps=8
             )
 
-            # JPEG形式で保存（品質85%）
-            imageio.imsave(thumb_path, rgb, format='jpeg', quality=85)
+            # 最大サイズに縮小してJPEG形式で保存（品質85%）
+            save_thumbnail(Image.fromarray(rgb, 'RGB'), thumb_path)
             logger.info(f"未処理イメージからのサムネイル生成完了: {thumb_path}")
             return True
 
@@ -165,15 +169,13 @@ def process_raw_file(raw_path: str, thumb_path: str) -> bool:
         logger.error(f"RAW処理エラー: {e}")
         return False
 
-def process_jpg_file(jpg_path: str, thumb_path: str) -> bool:
+def process_jpg_file(jpg_file: BinaryIO, thumb_path: str) -> bool:
     """JPGファイルからサムネイルを生成して保存"""
     try:
-        logger.info(f"JPG処理開始: {jpg_path}")
+        logger.info("JPG処理開始")
 
         # PILを使用してJPG画像を処理
-        from PIL import Image
-
-        with Image.open(jpg_path) as img:
+        with Image.open(jpg_file) as img:
             # 元のサイズを記録
             orig_width, orig_height = img.size
             logger.info(f"元の画像サイズ: {orig_width}x{orig_height}")
@@ -192,11 +194,13 @@ def process_jpg_file(jpg_path: str, thumb_path: str) -> bool:
                 img = img.resize((new_width, new_height), Image.LANCZOS)
                 logger.info(f"リサイズ後のサイズ: {new_width}x{new_height}")
 
-            # 品質を下げて保存（ファイルサイズ縮小のため）
-            img.save(thumb_path, format='JPEG', quality=80, optimize=True)
+            # 品質を下げてメモリ上でエンコード（ファイルサイズ縮小のため）
+            # 多くの場合はこれで目標サイズに収まるため、コストの高いハフマン最適化は行わない
+            buffer = io.BytesIO()
+            img.save(buffer, format='JPEG', quality=80, optimize=False, progressive=False)
 
-            # ファイルサイズを確認
-            thumb_size = os.path.getsize(thumb_path)
+            # サイズを確認
+            thumb_size = buffer.tell()
             logger.info(f"サムネイルサイズ: {thumb_size} bytes")
 
             # 目標サイズ: 100KB以下
@@ -204,8 +208,13 @@ def process_jpg_file(jpg_path: str, thumb_path: str) -> bool:
                 logger.info("サムネイルが100KBを超えています。さらに圧縮します。")
                 # サイズに応じて品質を調整
                 quality = max(50, 80 - int((thumb_size - 100 * 1024) / (20 * 1024)))
-                img.save(thumb_path, format='JPEG', quality=quality, optimize=True)
-                logger.info(f"再圧縮後のサイズ: {os.path.getsize(thumb_path)} bytes (品質: {quality})")
+                buffer = io.BytesIO()
+                img.save(buffer, format='JPEG', quality=quality, optimize=True, progressive=True)
+                logger.info(f"再圧縮後のサイズ: {buffer.tell()} bytes (品質: {quality})")
+
+            # 最終結果のみをファイルに書き込む
+            with open(thumb_path, 'wb') as f:
+                f.write(buffer.getbuffer())
 
             return True
 
@@ -213,120 +222,102 @@ def process_jpg_file(jpg_path: str, thumb_path: str) -> bool:
         logger.error(f"JPG処理エラー: {e}")
         return False
 
-def optimize_thumbnail(thumb_path: str, max_width: int = 1200, max_height: int = 1200) -> bool:
-    """サムネイルの最適化（大きすぎる場合のリサイズ）"""
-    try:
-        # PILを使用してリサイズが必要かチェック
-        from PIL import Image
-
-        with Image.open(thumb_path) as img:
-            width, height = img.size
-
-            # 最大サイズを超えている場合のみリサイズ
-            if width > max_width or height > max_height:
-                logger.info(f"サムネイルリサイズ: {width}x{height} -> 最大{max_width}x{max_height}")
-
-                # アスペクト比を維持してリサイズ
-                aspect = width / height
-                if width > height:
-                    new_width = min(width, max_width)
-                    new_height = int(new_width / aspect)
-                else:
-                    new_height = min(height, max_height)
-                    new_width = int(new_height * aspect)
-
-                # リサイズして保存
-                img = img.resize((new_width, new_height), Image.LANCZOS)
-                img.save(thumb_path, format='JPEG', quality=85, optimize=True)
-                logger.info(f"サムネイルリサイズ完了: {new_width}x{new_height}")
-
-            return True
-    except Exception as e:
-        logger.error(f"サムネイル最適化エラー: {e}")
-        return False
+def save_thumbnail(img: Image.Image, thumb_path: str) -> None:
+    """最大サイズを超える場合は縮小してからJPEG形式で保存"""
+    width, height = img.size
+    if width > THUMBNAIL_MAX_WIDTH or height > THUMBNAIL_MAX_HEIGHT:
+        logger.info(f"サムネイルリサイズ: {width}x{height} -> 最大{THUMBNAIL_MAX_WIDTH}x{THUMBNAIL_MAX_HEIGHT}")
+        # アスペクト比を維持してリサイズ
+        img.thumbnail((THUMBNAIL_MAX_WIDTH, THUMBNAIL_MAX_HEIGHT), Image.LANCZOS)
+        logger.info(f"サムネイルリサイズ完了: {img.width}x{img.height}")
+
+    img.save(thumb_path, format='JPEG', quality=85, optimize=False, progressive=False)
+
+def process_record(record: Dict[str, Any]) -> None:
+    """S3イベントレコード1件分のサムネイルを生成してアップロード"""
+    if record['eventSource'] != 'aws:s3' or not record['eventName'].startswith('ObjectCreated'):
+        return
+
+    bucket = record['s3']['bucket']['name']
+    # S3イベントのキーはURLエンコードされている（スペースは「+」）
+    key = unquote_plus(record['s3']['object']['key'])
+
+    # キーを確認し、サムネイルディレクトリのファイルは処理しない
+    if 'rawThumbnail' in key or 'jpgThumbnail' in key:
+        logger.info(f"サムネイルディレクトリのファイルはスキップします: {key}")
+        return
+
+    # ファイル名を取得
+    filename = os.path.basename(key)
+    # 拡張子はここで一度だけ分離して使い回す
+    stem, extension = os.path.splitext(filename)
+    extension = extension.lower()
+
+    logger.info(f"処理開始: バケット={bucket}, キー={key}, ファイル名={filename}")
+
+    # ファイルタイプチェック
+    if extension not in SUPPORTED_EXTENSIONS:
+        logger.info(f"サポートされていないファイル形式のためスキップします: {filename}")
+        return
+
+    is_raw = extension in RAW_EXTENSIONS
+    is_jpg = not is_raw
+
+    # サムネイル保存先パスを生成
+    thumbnail_key = generate_thumbnail_path(key, stem)
+    if not thumbnail_key:
+        logger.error(f"サムネイルパス生成失敗: {key}")
+        return
+
+    logger.info(f"サムネイル保存先: {thumbnail_key}")
+
+    # 並列処理時にファイル名が衝突しないよう、レコードごとに一時ディレクトリを使用
+    # （ディレクトリごと自動的に削除される）
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_output_path = os.path.join(temp_dir, f"{stem}_thumb.jpg")
+
+        # S3からファイルを取得
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+
+        # ファイルタイプに応じた処理
+        success = False
+        if is_raw:
+            # RAWファイル処理（rawpyはファイルパスが必要なため一時ファイルへストリーミング）
+            with tempfile.NamedTemporaryFile(suffix=extension, dir=temp_dir) as temp_input:
+                shutil.copyfileobj(response['Body'], temp_input, STREAM_CHUNK_SIZE)
+                temp_input.flush()
+                logger.info(f"ファイルダウンロード完了: {temp_input.name}")
+                success = process_raw_file(temp_input.name, temp_output_path)
+        elif is_jpg:
+            # JPGファイル処理（一時ファイルを介さずメモリ上で処理）
+            success = process_jpg_file(io.BytesIO(response['Body'].read()), temp_output_path)
+
+        if not success:
+            logger.error(f"サムネイル生成失敗: {filename}")
+            return
+
+        # サムネイルをS3にアップロード
+        s3_client.upload_file(
+            temp_output_path,
+            bucket,
+            thumbnail_key,
+            ExtraArgs={'ContentType': 'image/jpeg'}
+        )
+        logger.info(f"サムネイルアップロード完了: {thumbnail_key}")
 
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """Lambda関数ハンドラー"""
-    logger.info(f"S3イベント受信: {json.dumps(event)}")
+    # ログ出力が無効な場合はイベントのJSON変換自体を行わない
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("S3イベント受信: %s", json.dumps(event))
 
     try:
-        # イベントからS3情報を取得
-        for record in event['Records']:
-            if record['eventSource'] != 'aws:s3' or not record['eventName'].startswith('ObjectCreated'):
-                continue
-
-            bucket = record['s3']['bucket']['name']
-            key = record['s3']['object']['key'].replace('%3A', ':').replace('%2B', '+').replace('%20', ' ')
-
-            # キーを確認し、サムネイルディレクトリのファイルは処理しない
-            if 'rawThumbnail' in key or 'jpgThumbnail' in key:
-                logger.info(f"サムネイルディレクトリのファイルはスキップします: {key}")
-                continue
-
-            # ファイル名を取得
-            filename = os.path.basename(key)
-
-            logger.info(f"処理開始: バケット={bucket}, キー={key}, ファイル名={filename}")
-
-            # ファイルタイプチェック
-            is_raw = is_raw_file(filename)
-            is_jpg = is_jpg_file(filename)
-
-            if not (is_raw or is_jpg):
-                logger.info(f"サポートされていないファイル形式のためスキップします: {filename}")
-                continue
-
-            # サムネイル保存先パスを生成
-            thumbnail_key = generate_thumbnail_path(key, filename)
-            if not thumbnail_key:
-                logger.error(f"サムネイルパス生成失敗: {key}")
-                continue
-
-            logger.info(f"サムネイル保存先: {thumbnail_key}")
-
-            # 一時ファイルのパスを設定
-            temp_dir = '/tmp'
-            temp_input_path = os.path.join(temp_dir, filename)
-            temp_output_path = os.path.join(temp_dir, f"{os.path.splitext(filename)[0]}_thumb.jpg")
-
-            try:
-                # S3からファイルをダウンロード
-                s3_client.download_file(bucket, key, temp_input_path)
-                logger.info(f"ファイルダウンロード完了: {temp_input_path}")
-
-                # ファイルタイプに応じた処理
-                success = False
-                if is_raw:
-                    # RAWファイル処理
-                    success = process_raw_file(temp_input_path, temp_output_path)
-                elif is_jpg:
-                    # JPGファイル処理
-                    success = process_jpg_file(temp_input_path, temp_output_path)
-
-                if not success:
-                    logger.error(f"サムネイル生成失敗: {filename}")
-                    continue
-
-                # サムネイル最適化
-                if not optimize_thumbnail(temp_output_path):
-                    logger.warning(f"サムネイル最適化失敗: {temp_output_path}")
-
-                # サムネイルをS3にアップロード
-                s3_client.upload_file(
-                    temp_output_path,
-                    bucket,
-                    thumbnail_key,
-                    ExtraArgs={'ContentType': 'image/jpeg'}
-                )
-                logger.info(f"サムネイルアップロード完了: {thumbnail_key}")
-
-            finally:
-                # 一時ファイルを削除
-                if os.path.exists(temp_input_path):
-                    os.remove(temp_input_path)
-                if os.path.exists(temp_output_path):
-                    os.remove(temp_output_path)
-                logger.info("一時ファイルの削除完了")
+        # 各レコードを並列に処理し、S3のI/O待ちと画像処理を重ねる
+        records = event['Records']
+        if records:
+            with ThreadPoolExecutor(max_workers=min(MAX_RECORD_WORKERS, len(records))) as executor:
+                # 結果を消費して、レコード処理中の例外を呼び出し元に伝える
+                list(executor.map(process_record, records))
 
         return {
             'statusCode': 200,
@@ -338,4 +329,4 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         return {
             'statusCode': 500,
             'body': json.dumps(f"エラー: {str(e)}")
-        }
\ No newline at end of file
+        }
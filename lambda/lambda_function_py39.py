@@ -7,11 +7,16 @@ Python 3.9 + rawpy対応版
 import json
 import boto3
 import rawpy
-import imageio
 import os
+import io
+import re
+import shutil
+import tempfile
 import logging
 from datetime import datetime
+from urllib.parse import unquote_plus
 from typing import Dict, Any, Optional, List, Tuple
+from PIL import Image
 
 # ロギング設定
 logger = logging.getLogger()
@@ -20,8 +25,15 @@ logger.setLevel(logging.INFO)
 # S3クライアント初期化
 s3_client = boto3.client('s3')
 
-# サポートするRAW拡張子のリスト
-RAW_EXTENSIONS = [
+# S3からのストリーミングコピー単位(1MB)
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# サムネイルの最大サイズ
+THUMBNAIL_MAX_WIDTH = 1200
+THUMBNAIL_MAX_HEIGHT = 1200
+
+# サポートするRAW拡張子のセット
+RAW_EXTENSIONS = frozenset({
     '.arw',  # Sony
     '.cr2', '.cr3',  # Canon
     '.dng',  # Adobe DNG
@@ -43,55 +55,36 @@ RAW_EXTENSIONS = [
     '.erf',  # Epson
     '.mos',  # Leaf
     '.rwz',  # Rawzor
-]
-
-def get_file_extension(filename: str) -> str:
-    """ファイルの拡張子を取得"""
-    return os.path.splitext(filename)[1].lower()
+})
 
-def is_raw_file(filename: str) -> bool:
-    """RAWファイルかどうかを判定"""
-    extension = get_file_extension(filename)
-    return extension in RAW_EXTENSIONS
+# S3パス解析用パターン: user/userId/raw/year/month/day/filename.ext
+PATH_INFO_PATTERN = re.compile(
+    r'^[^/]*/(?P<user_id>[^/]*)/[^/]*/(?P<year>\d+)/(?P<month>\d+)/(?P<day>\d+)/'
+)
 
 def extract_path_info(key: str) -> Optional[Dict[str, str]]:
     """S3パスからユーザーIDと日付情報を抽出"""
     # パスの例: user/abc123/raw/2023/04/15/file.x3f
-    path_parts = key.split('/')
-    if len(path_parts) < 7:  # 必要な階層が足りない
+    match = PATH_INFO_PATTERN.match(key)
+    if not match:  # 必要な階層が足りない、または日付部分が数値ではない
         logger.warning(f"無効なパス形式: {key}")
         return None
 
-    try:
-        # user/userId/raw/year/month/day/filename.ext
-        user_id = path_parts[1]
-        year = path_parts[3]
-        month = path_parts[4]
-        day = path_parts[5]
-
-        # 数値形式の検証
-        if not (year.isdigit() and month.isdigit() and day.isdigit()):
-            logger.warning(f"パスの日付部分が数値ではありません: {key}")
-            return None
+    return {
+        "user_id": match.group('user_id'),
+        "year": match.group('year'),
+        "month": match.group('month').zfill(2),  # 1桁の場合は0埋め
+        "day": match.group('day').zfill(2)  # 1桁の場合は0埋め
+    }
 
-        return {
-            "user_id": user_id,
-            "year": year,
-            "month": month.zfill(2),  # 1桁の場合は0埋め
-            "day": day.zfill(2)  # 1桁の場合は0埋め
-        }
-    except Exception as e:
-        logger.error(f"パス情報抽出エラー: {e}")
-        return None
-
-def generate_thumbnail_path(source_key: str, filename: str) -> Optional[str]:
+def generate_thumbnail_path(source_key: str, stem: str) -> Optional[str]:
     """サムネイル保存先のS3パスを生成"""
     path_info = extract_path_info(source_key)
     if not path_info:
         return None
 
-    # サムネイル用のファイル名を生成（拡張子をjpgに変更）
-    thumbnail_filename = os.path.splitext(filename)[0] + "_thumb.jpg"
+    # サムネイル用のファイル名を生成（拡張子を除いたファイル名 + _thumb.jpg）
+    thumbnail_filename = stem + "_thumb.jpg"
 
     # サムネイル保存先のパスを生成
     return f"user/{path_info['user_id']}/rawThumbnail/{path_info['year']}/{path_info['month']}/{path_info['day']}/{thumbnail_filename}"
@@ -105,15 +98,25 @@ def process_raw_file(raw_path: str, thumb_path: str) -> bool:
             # まず埋め込みサムネイルの取得を試みる
             try:
                 thumb = raw.extract_thumb()
-                if thumb.format == 'jpeg':
+                if thumb.format == rawpy.ThumbFormat.JPEG:
                     # JPEGサムネイルがある場合
                     logger.info("埋め込みJPEGサムネイル抽出成功")
-                    with open(thumb_path, 'wb') as f:
-                        f.write(thumb.data)
+                    with Image.open(io.BytesIO(thumb.data)) as img:
+                        if img.width <= THUMBNAIL_MAX_WIDTH and img.height <= THUMBNAIL_MAX_HEIGHT:
+                            # 最大サイズ以内ならデコードせずそのまま保存
+                            with open(thumb_path, 'wb') as f:
+                                f.write(thumb.data)
+                        else:
+                            save_thumbnail(img, thumb_path)
+                    return True
+                elif thumb.format == rawpy.ThumbFormat.BITMAP:
+                    # ビットマップ形式の場合はデモザイク処理をせずJPEGに変換
+                    logger.info("埋め込みビットマップサムネイル抽出成功")
+                    save_thumbnail(Image.fromarray(thumb.data), thumb_path)
                     return True
                 else:
-                    # 埋め込みサムネイルがあるがJPEGではない場合
-                    logger.info(f"埋め込みサムネイルはJPEG形式ではありません: {thumb.format}")
+                    # 埋め込みサムネイルがあるが未対応の形式の場合
+                    logger.info(f"埋め込みサムネイルは未対応の形式です: {thumb.format}")
             except (rawpy.LibRawError, OSError) as e:
                 # サムネイル取得に失敗した場合
                 logger.info(f"埋め込みサムネイル抽出失敗: {e}")
@@ -131,9 +134,8 @@ def process_raw_file(raw_path: str, thumb_path: str) -> bool:
                 no_auto_bright=True
             )
 
-            # JPEG形式で保存（品質85%）
-            # Python 3.9のimageioでは少し異なるAPIを使用
-            imageio.imwrite(thumb_path, rgb, format='jpeg', quality=85)
+            # 最大サイズに縮小してJPEG形式で保存（品質85%）
+            save_thumbnail(Image.fromarray(rgb, 'RGB'), thumb_path)
             logger.info(f"未処理イメージからのサムネイル生成完了: {thumb_path}")
             return True
 
@@ -141,54 +143,39 @@ def process_raw_file(raw_path: str, thumb_path: str) -> bool:
         logger.error(f"RAW処理エラー: {e}")
         return False
 
-def optimize_thumbnail(thumb_path: str, max_width: int = 1200, max_height: int = 1200) -> bool:
-    """サムネイルの最適化（大きすぎる場合のリサイズ）"""
-    try:
-        # PILを使用してリサイズが必要かチェック
-        from PIL import Image
-
-        with Image.open(thumb_path) as img:
-            width, height = img.size
-
-            # 最大サイズを超えている場合のみリサイズ
-            if width > max_width or height > max_height:
-                logger.info(f"サムネイルリサイズ: {width}x{height} -> 最大{max_width}x{max_height}")
-
-                # アスペクト比を維持してリサイズ
-                aspect = width / height
-                if width > height:
-                    new_width = min(width, max_width)
-                    new_height = int(new_width / aspect)
-                else:
-                    new_height = min(height, max_height)
-                    new_width = int(new_height * aspect)
+def save_thumbnail(img: Image.Image, thumb_path: str) -> None:
+    """最大サイズを超える場合は縮小してからJPEG形式で保存"""
+    width, height = img.size
+    if width > THUMBNAIL_MAX_WIDTH or height > THUMBNAIL_MAX_HEIGHT:
+        logger.info(f"サムネイルリサイズ: {width}x{height} -> 最大{THUMBNAIL_MAX_WIDTH}x{THUMBNAIL_MAX_HEIGHT}")
+        # アスペクト比を維持してリサイズ
+        img.thumbnail((THUMBNAIL_MAX_WIDTH, THUMBNAIL_MAX_HEIGHT), Image.LANCZOS)
+        logger.info(f"サムネイルリサイズ完了: {img.width}x{img.height}")
 
-                # Python 3.9では、Image.LANCZOSはPython 3.13のImage.LANCZOSと同等
-                img = img.resize((new_width, new_height), Image.LANCZOS)
-                img.save(thumb_path, format='JPEG', quality=85, optimize=True)
-                logger.info(f"サムネイルリサイズ完了: {new_width}x{new_height}")
-
-            return True
-    except Exception as e:
-        logger.error(f"サムネイル最適化エラー: {e}")
-        return False
+    img.save(thumb_path, format='JPEG', quality=85, optimize=False, progressive=False)
 
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """Lambda関数ハンドラー"""
-    logger.info(f"S3イベント受信: {json.dumps(event)}")
+    # ログ出力が無効な場合はイベントのJSON変換自体を行わない
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("S3イベント受信: %s", json.dumps(event))
 
     try:
         # イベントからS3情報を取得
         bucket = event['Records'][0]['s3']['bucket']['name']
-        key = event['Records'][0]['s3']['object']['key'].replace('%3A', ':').replace('%2B', '+').replace('%20', ' ')
+        # S3イベントのキーはURLエンコードされている（スペースは「+」）
+        key = unquote_plus(event['Records'][0]['s3']['object']['key'])
 
         # ファイル名を取得
         filename = os.path.basename(key)
+        # 拡張子はここで一度だけ分離して使い回す
+        stem, extension = os.path.splitext(filename)
+        extension = extension.lower()
 
         logger.info(f"処理開始: バケット={bucket}, キー={key}, ファイル名={filename}")
 
         # RAWファイルかどうかをチェック
-        if not is_raw_file(filename):
+        if extension not in RAW_EXTENSIONS:
             logger.info(f"RAWファイルではないためスキップします: {filename}")
             return {
                 'statusCode': 200,
@@ -196,7 +183,7 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             }
 
         # サムネイル保存先パスを生成
-        thumbnail_key = generate_thumbnail_path(key, filename)
+        thumbnail_key = generate_thumbnail_path(key, stem)
         if not thumbnail_key:
             return {
                 'statusCode': 400,
@@ -206,21 +193,20 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         logger.info(f"サムネイル保存先: {thumbnail_key}")
 
         # 一時ファイルパス
-        tmp_raw_path = f"/tmp/{filename}"
         tmp_thumb_path = f"/tmp/thumb_{filename.replace('.', '_')}.jpg"
 
         try:
-            # S3からRAWファイルをダウンロード
+            # S3からRAWファイルを取得し、rawpy用の一時ファイルへストリーミング
             logger.info(f"S3からRAWファイルダウンロード開始: {bucket}/{key}")
-            s3_client.download_file(bucket, key, tmp_raw_path)
-            logger.info(f"RAWファイルダウンロード完了: {tmp_raw_path}")
-
-            # RAWファイルからサムネイルを抽出
-            if not process_raw_file(tmp_raw_path, tmp_thumb_path):
-                raise Exception("サムネイル抽出に失敗しました")
+            response = s3_client.get_object(Bucket=bucket, Key=key)
+            with tempfile.NamedTemporaryFile(suffix=extension) as tmp_raw:
+                shutil.copyfileobj(response['Body'], tmp_raw, STREAM_CHUNK_SIZE)
+                tmp_raw.flush()
+                logger.info(f"RAWファイルダウンロード完了: {tmp_raw.name}")
 
-            # サムネイルを最適化
-            optimize_thumbnail(tmp_thumb_path)
+                # RAWファイルからサムネイルを抽出
+                if not process_raw_file(tmp_raw.name, tmp_thumb_path):
+                    raise Exception("サムネイル抽出に失敗しました")
 
             # サムネイルをS3にアップロード
             logger.info(f"サムネイルアップロード開始: {bucket}/{thumbnail_key}")
@@ -246,8 +232,6 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
 
         finally:
             # 一時ファイルの削除
-            if os.path.exists(tmp_raw_path):
-                os.remove(tmp_raw_path)
             if os.path.exists(tmp_thumb_path):
                 os.remove(tmp_thumb_path)
 
@@ -5,16 +5,24 @@ S3のイベント通知を受け取り、オブジェクトの復元完了時に
 
 import json
 import boto3
+from boto3.s3.transfer import TransferConfig
 import os
+import re
+import time
+import hashlib
+import hmac
+from datetime import datetime, timezone
+from functools import lru_cache
 import logging
+from botocore.config import Config
 from botocore.exceptions import ClientError
-from urllib.parse import unquote_plus
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
-import io
+from urllib.parse import unquote_plus, quote
+from collections import defaultdict, deque
 import zipfile
-from DynamoDBClient import DynamoDBClient, PutItemCommand
+import shutil
+import threading
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 
 # ロギング設定
 logger = logging.getLogger()
@@ -25,36 +33,150 @@ SENDER_EMAIL = os.environ.get('SENDER_EMAIL', 'noreply@example.com')
 S3_BUCKET = os.environ.get('S3_BUCKET', 'photo-upload-s3-app')
 PRESIGNED_URL_EXPIRY = int(os.environ.get('PRESIGNED_URL_EXPIRY', '86400'))  # デフォルト24時間(秒)
 DYNAMODB_TABLE = os.environ.get('DYNAMODB_TABLE', 'user-emails')
+DYNAMODB_BATCH_GET_LIMIT = 100  # BatchGetItemで一度に取得できる最大キー数
+DYNAMODB_RETRY_BASE_DELAY = 0.05  # 未処理キー再リクエストの初回待機時間(秒)
+DYNAMODB_RETRY_MAX_DELAY = 2.0  # 未処理キー再リクエストの最大待機時間(秒)
+DYNAMODB_MAX_RETRIES = 5  # 未処理キー再リクエストの最大回数
+SES_TEMPLATE_NAME = os.environ.get('SES_TEMPLATE_NAME', 'PhotoRestoreTemplate')
+SES_BULK_DESTINATION_LIMIT = 50  # SendBulkTemplatedEmailで一度に指定できる最大宛先数
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '32'))  # 署名・取得の並列数上限
+STREAM_CHUNK_SIZE = 1024 * 1024  # ZIP書き込み時のコピー単位(1MB)
+# ZIP作成時に先行して開いておくS3オブジェクト数（開いたストリームは接続を占有するため少数に抑える）
+ZIP_PREFETCH_OBJECTS = int(os.environ.get('ZIP_PREFETCH_OBJECTS', '4'))
+# S3接続プールの上限（並列取得数 + マルチパートアップロードのスレッド数を賄える大きさ）
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', '64'))
+
+# ZIPアップロード用の転送設定（8MB単位のマルチパートアップロード）
+ZIP_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    use_threads=True
+)
+
+# S3オブジェクトキーからユーザーIDを取り出すパターン
+USER_ID_PATTERN = re.compile(r'^user/([^/]*)/')
+
+# 通知メールの固定部分（呼び出しごとに組み立てないようモジュール読み込み時に用意）
+EMAIL_SUBJECT = "写真の復元が完了しました"
+
+HTML_EMAIL_HEADER = """
+    <html>
+    <head>
+      <style>
+        body { font-family: Arial, sans-serif; line-height: 1.6; color: #333; }
+        .container { max-width: 600px; margin: 0 auto; padding: 20px; }
+        h2 { color: #2c3e50; }
+        ul { padding-left: 20px; }
+        li { margin-bottom: 10px; }
+        .button { display: inline-block; background-color: #3498db; color: white;
+                  padding: 10px 15px; text-decoration: none; border-radius: 5px; }
+        .button:hover { background-color: #2980b9; }
+        .footer { margin-top: 30px; font-size: 12px; color: #7f8c8d; }
+      </style>
+    </head>
+    <body>
+      <div class="container">
+        <h2>写真の復元が完了しました</h2>
+        <p>リクエストいただいた以下のファイルの復元が完了しました。</p>
 
-# AWS クライアント初期化
-s3_client = boto3.client('s3')
-ses_client = boto3.client('ses')
-dynamodb = boto3.resource('dynamodb')
+        <ul>
+    """
+
+HTML_EMAIL_FOOTER = """
+        <p>ダウンロードリンクは24時間有効です。期限が切れた場合は、アプリから再度復元をリクエストしてください。</p>
 
-def get_user_email(user_id):
+        <div class="footer">
+          <p>※このメールは自動送信されています。ご返信いただいても対応できません。</p>
+        </div>
+      </div>
+    </body>
+    </html>
     """
-    DynamoDBからユーザーのメールアドレスを取得
+
+TEXT_EMAIL_HEADER = """
+写真の復元が完了しました
+
+リクエストいただいた以下のファイルの復元が完了しました：
+
+"""
+
+TEXT_EMAIL_FOOTER = """
+ダウンロードリンクは24時間有効です。期限が切れた場合は、アプリから再度復元をリクエストしてください。
+
+※このメールは自動送信されています。ご返信いただいても対応できません。
     """
-    try:
-        table = dynamodb.Table(DYNAMODB_TABLE)
-        response = table.get_item(Key={'userId': user_id})
-        if 'Item' in response and 'email' in response['Item']:
-            return response['Item']['email']
-        logger.warning(f"ユーザーID {user_id} のメールアドレスが見つかりません")
-        return None
-    except ClientError as e:
-        logger.error(f"DynamoDB エラー: {e}")
-        return None
+
+# 一括送信用SESテンプレート（create_email_templateで登録する）
+EMAIL_TEMPLATE = {
+    'TemplateName': SES_TEMPLATE_NAME,
+    'SubjectPart': EMAIL_SUBJECT,
+    'HtmlPart': HTML_EMAIL_HEADER + """{{#each files}}<li><a href="{{url}}">{{name}}</a></li>
+{{/each}}{{#if zipUrl}}
+        </ul>
+
+        <p>すべてのファイルを一括でダウンロードすることもできます：</p>
+        <p><a href="{{zipUrl}}" class="button">すべてをZIPでダウンロード</a></p>
+        {{else}}</ul>{{/if}}""" + HTML_EMAIL_FOOTER,
+    'TextPart': TEXT_EMAIL_HEADER + """{{#each files}}- {{{name}}}: {{{url}}}
+{{/each}}{{#if zipUrl}}
+すべてのファイルを一括ダウンロード: {{{zipUrl}}}
+{{/if}}""" + TEXT_EMAIL_FOOTER,
+}
+
+# AWS クライアント初期化
+session = boto3.session.Session()
+s3_client = session.client('s3', config=Config(
+    max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+    retries={'max_attempts': 3, 'mode': 'adaptive'},
+    s3={'addressing_style': 'virtual'},
+    tcp_keepalive=True
+))
+ses_client = session.client('ses')
+dynamodb = session.resource('dynamodb')
+
+def get_user_emails(user_ids):
+    """
+    DynamoDBから複数ユーザーのメールアドレスをBatchGetItemで一括取得
+    戻り値: {ユーザーID: メールアドレス}
+    """
+    emails = {}
+    for i in range(0, len(user_ids), DYNAMODB_BATCH_GET_LIMIT):
+        request_items = {
+            DYNAMODB_TABLE: {
+                'Keys': [{'userId': user_id} for user_id in user_ids[i:i + DYNAMODB_BATCH_GET_LIMIT]]
+            }
+        }
+        try:
+            # 未処理のキーが返された場合は指数バックオフで待ってから再リクエスト（最大DYNAMODB_MAX_RETRIES回）
+            retry_count = 0
+            while request_items:
+                if retry_count > DYNAMODB_MAX_RETRIES:
+                    unprocessed = [key['userId'] for key in request_items.get(DYNAMODB_TABLE, {}).get('Keys', [])]
+                    logger.error(f"DynamoDB の未処理キーが再試行上限に達しました: {unprocessed}")
+                    break
+                if retry_count:
+                    time.sleep(min(DYNAMODB_RETRY_MAX_DELAY, DYNAMODB_RETRY_BASE_DELAY * (2 ** (retry_count - 1))))
+                response = dynamodb.batch_get_item(RequestItems=request_items)
+                for item in response.get('Responses', {}).get(DYNAMODB_TABLE, []):
+                    if 'email' in item:
+                        emails[item['userId']] = item['email']
+                request_items = response.get('UnprocessedKeys')
+                retry_count += 1
+        except ClientError as e:
+            logger.error(f"DynamoDB エラー: {e}")
+
+    for user_id in user_ids:
+        if user_id not in emails:
+            logger.warning(f"ユーザーID {user_id} のメールアドレスが見つかりません")
+    return emails
 
 def extract_user_id_from_key(key):
     """
     S3オブジェクトキーからユーザーIDを抽出
     例: user/abc123/raw/2023/04/15/file.RAF -> abc123
     """
-    parts = key.split('/')
-    if len(parts) > 2 and parts[0] == 'user':
-        return parts[1]
-    return None
+    match = USER_ID_PATTERN.match(key)
+    return match.group(1) if match else None
 
 def generate_presigned_url(bucket, key, expiry=PRESIGNED_URL_EXPIRY):
     """
@@ -71,6 +193,143 @@ def generate_presigned_url(bucket, key, expiry=PRESIGNED_URL_EXPIRY):
         logger.error(f"プレスポンドURL生成エラー: {e}")
         return None
 
+@lru_cache(maxsize=8)
+def derive_sigv4_signing_key(secret_key, date_stamp, region, service='s3'):
+    """
+    SigV4の署名鍵を導出（同じ日付・リージョンの間は再利用される）
+    """
+    signing_key = ('AWS4' + secret_key).encode('utf-8')
+    for part in (date_stamp, region, service, 'aws4_request'):
+        signing_key = hmac.new(signing_key, part.encode('utf-8'), hashlib.sha256).digest()
+    return signing_key
+
+def sign_presigned_urls(bucket, keys, expiry, credentials, region):
+    """
+    署名鍵を一度だけ導出し、各キーのGET用プレスポンドURLをローカルで署名
+    """
+    now = datetime.now(timezone.utc)
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    date_stamp = now.strftime('%Y%m%d')
+    scope = f"{date_stamp}/{region}/s3/aws4_request"
+    signing_key = derive_sigv4_signing_key(credentials.secret_key, date_stamp, region)
+
+    # ドットを含むバケット名は仮想ホスト形式だと証明書が一致しないためパス形式を使用
+    if '.' in bucket:
+        host = f"s3.{region}.amazonaws.com"
+        path_prefix = '/' + quote(bucket, safe='~')
+    else:
+        host = f"{bucket}.s3.{region}.amazonaws.com"
+        path_prefix = ''
+
+    # 全キー共通のクエリパラメータ（キー順にソート済みで組み立てる）
+    params = {
+        'X-Amz-Algorithm': 'AWS4-HMAC-SHA256',
+        'X-Amz-Credential': f"{credentials.access_key}/{scope}",
+        'X-Amz-Date': amz_date,
+        'X-Amz-Expires': str(expiry),
+        'X-Amz-SignedHeaders': 'host',
+    }
+    if credentials.token:
+        params['X-Amz-Security-Token'] = credentials.token
+    query = '&'.join(
+        f"{quote(name, safe='~')}={quote(value, safe='~')}" for name, value in sorted(params.items())
+    )
+
+    urls = []
+    for key in keys:
+        path = path_prefix + '/' + quote(key, safe='/~')
+        canonical_request = f"GET\n{path}\n{query}\nhost:{host}\n\nhost\nUNSIGNED-PAYLOAD"
+        string_to_sign = (
+            f"AWS4-HMAC-SHA256\n{amz_date}\n{scope}\n"
+            f"{hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()}"
+        )
+        signature = hmac.new(signing_key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+        urls.append(f"https://{host}{path}?{query}&X-Amz-Signature={signature}")
+    return urls
+
+def generate_presigned_urls(bucket, keys, expiry=PRESIGNED_URL_EXPIRY):
+    """
+    複数キーのプレスポンドURLを生成（キーと同じ順序で返す）
+    """
+    if not keys:
+        return []
+
+    # 認証情報とリージョンが取得できる場合は署名鍵を共有してローカルで一括署名
+    credentials = session.get_credentials()
+    region = s3_client.meta.region_name
+    if credentials and region and region != 'aws-global':
+        try:
+            return sign_presigned_urls(bucket, keys, expiry, credentials.get_frozen_credentials(), region)
+        except Exception as e:
+            logger.warning(f"一括署名に失敗したため個別に生成します: {e}")
+
+    # 取得できない場合はboto3で並列に生成
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(keys))) as executor:
+        return list(executor.map(lambda key: generate_presigned_url(bucket, key, expiry), keys))
+
+def open_object_for_zip(key):
+    """
+    ZIP格納用にS3オブジェクトを開き (ファイル名, ストリーム) を返す
+    """
+    try:
+        response = s3_client.get_object(Bucket=S3_BUCKET, Key=key)
+        # ZIP内ではファイル名のみ使用
+        return key.split('/')[-1], response['Body']
+    except Exception as e:
+        logger.error(f"ファイル {key} の処理中にエラーが発生しました: {e}")
+        return None
+
+def write_zip_to_stream(keys, stream):
+    """
+    指定キーのファイルをZIP形式でストリームに書き込む
+    S3からの取得はZIP_PREFETCH_OBJECTS件まで先行して行い、ZipFileはスレッドセーフではないため書き込みは逐次行う
+    写真データは圧縮済みのため、DEFLATEせず無圧縮(STORED)で格納する
+    取得できなかったファイルは除外するが、書き込み途中で失敗した場合は例外を送出してZIP全体を中止する
+    """
+    key_iter = iter(keys)
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED, allowZip64=True) as zip_file, \
+            ThreadPoolExecutor(max_workers=min(ZIP_PREFETCH_OBJECTS, len(keys))) as executor:
+        pending = deque(executor.submit(open_object_for_zip, key) for key in islice(key_iter, ZIP_PREFETCH_OBJECTS))
+        while pending:
+            entry = pending.popleft().result()
+
+            # 1件取り出すごとに次のファイルを開き始める
+            next_key = next(key_iter, None)
+            if next_key is not None:
+                pending.append(executor.submit(open_object_for_zip, next_key))
+
+            if not entry:
+                continue
+
+            # ファイル全体を読み込まず、一定サイズずつZIPへコピーする
+            file_name, body = entry
+            try:
+                with body, zip_file.open(file_name, 'w', force_zip64=True) as dest:
+                    shutil.copyfileobj(body, dest, STREAM_CHUNK_SIZE)
+            except Exception as e:
+                # 書き戻しできないストリームでは途中まで書いたエントリを取り消せないため、ZIP全体を中止する
+                logger.error(f"ファイル {file_name} のZIP書き込み中にエラーが発生しました: {e}")
+                for future in pending:
+                    opened = future.result()
+                    if opened:
+                        opened[1].close()
+                raise
+
+class ZipPipeReader:
+    """
+    ZIP生成スレッドが書き込むパイプの読み込み側
+    生成側が失敗した後に終端へ達した場合は例外を送出し、途中までのZIPでアップロードが完了しないようにする
+    """
+    def __init__(self, reader, producer_failed):
+        self.reader = reader
+        self.producer_failed = producer_failed
+
+    def read(self, size=-1):
+        data = self.reader.read(size)
+        if not data and self.producer_failed.is_set():
+            raise IOError("ZIP生成中にエラーが発生したためアップロードを中止します")
+        return data
+
 def create_download_zip_url(keys, zip_name="download", expiry=PRESIGNED_URL_EXPIRY):
     """
     複数ファイルのZIPダウンロード用URLを生成
@@ -81,33 +340,46 @@ def create_download_zip_url(keys, zip_name="download", expiry=PRESIGNED_URL_EXPI
     # 一時的なS3キーを作成（ユーザーIDと日時を含める）
     first_key = keys[0]
     user_id = extract_user_id_from_key(first_key)
-    timestamp = int(boto3.client('dynamodb').describe_endpoints()['TimeSeconds'])
+    timestamp = int(time.time())
     temp_zip_key = f"temp/{user_id}/{timestamp}_{zip_name}.zip"
 
-    # ZIPファイルを作成
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for key in keys:
+    # ZIPをメモリに溜めず、パイプ経由でS3へマルチパートアップロードする
+    read_fd, write_fd = os.pipe()
+    producer_failed = threading.Event()
+
+    def produce_zip():
+        writer = os.fdopen(write_fd, 'wb')
+        try:
+            write_zip_to_stream(keys, writer)
+        except BaseException:
+            # 書き込み側を閉じる（読み込み側が終端に達する）前に失敗を記録する
+            producer_failed.set()
+            raise
+        finally:
+            writer.close()
+
+    with ThreadPoolExecutor(max_workers=1) as producer:
+        future = producer.submit(produce_zip)
+        with os.fdopen(read_fd, 'rb') as reader:
             try:
-                # S3からファイルを取得
-                response = s3_client.get_object(Bucket=S3_BUCKET, Key=key)
-                file_content = response['Body'].read()
-
-                # ZIPにファイルを追加（ファイル名のみ使用）
-                file_name = key.split('/')[-1]
-                zip_file.writestr(file_name, file_content)
-            except Exception as e:
-                logger.error(f"ファイル {key} の処理中にエラーが発生しました: {e}")
-
-    # S3にZIPファイルをアップロード
-    zip_buffer.seek(0)
-    s3_client.put_object(
-        Bucket=S3_BUCKET,
-        Key=temp_zip_key,
-        Body=zip_buffer.getvalue(),
-        ContentType='application/zip',
-        Metadata={'auto-delete': 'true', 'ttl': str(timestamp + expiry)}
-    )
+                # 読み込み側で例外が発生した場合、マルチパートアップロードは中止される
+                s3_client.upload_fileobj(
+                    ZipPipeReader(reader, producer_failed),
+                    S3_BUCKET,
+                    temp_zip_key,
+                    ExtraArgs={
+                        'ContentType': 'application/zip',
+                        'Metadata': {'auto-delete': 'true', 'ttl': str(timestamp + expiry)}
+                    },
+                    Config=ZIP_TRANSFER_CONFIG
+                )
+            except Exception:
+                # ZIP生成側のエラーが原因の場合はそちらを呼び出し元に伝える
+                if producer_failed.is_set():
+                    future.result()
+                raise
+        # ZIP生成側のエラーを呼び出し元に伝える
+        future.result()
 
     # 署名付きURLを生成
     return generate_presigned_url(S3_BUCKET, temp_zip_key, expiry)
@@ -119,97 +391,53 @@ def send_notification_email(email, file_keys, urls):
     if not email or not urls:
         return False
 
-    # メールの件名と本文
-    subject = "写真の復元が完了しました"
-
-    # HTMLメール本文
-    html_body = f"""
-    <html>
-    <head>
-      <style>
-        body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
-        .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
-        h2 {{ color: #2c3e50; }}
-        ul {{ padding-left: 20px; }}
-        li {{ margin-bottom: 10px; }}
-        .button {{ display: inline-block; background-color: #3498db; color: white;
-                  padding: 10px 15px; text-decoration: none; border-radius: 5px; }}
-        .button:hover {{ background-color: #2980b9; }}
-        .footer {{ margin-top: 30px; font-size: 12px; color: #7f8c8d; }}
-      </style>
-    </head>
-    <body>
-      <div class="container">
-        <h2>写真の復元が完了しました</h2>
-        <p>リクエストいただいた以下のファイルの復元が完了しました。</p>
-
-        <ul>
-    """
+    # HTMLメール本文（部品をリストに集めて最後に連結する）
+    html_parts = [HTML_EMAIL_HEADER]
 
     # 各ファイルとダウンロードリンクを追加
     for i, key in enumerate(file_keys):
         file_name = key.split('/')[-1]
-        html_body += f'<li><a href="{urls[i]}">{file_name}</a></li>\n'
+        html_parts.append(f'<li><a href="{urls[i]}">{file_name}</a></li>\n')
 
     # 複数ファイルの場合、ZIPダウンロードリンクを追加
     if len(file_keys) > 1 and urls[-1] != urls[-2]:  # 最後のURLが特別な場合（ZIPファイル）
-        html_body += f"""
+        html_parts.append(f"""
         </ul>
 
         <p>すべてのファイルを一括でダウンロードすることもできます：</p>
         <p><a href="{urls[-1]}" class="button">すべてをZIPでダウンロード</a></p>
-        """
+        """)
     else:
-        html_body += "</ul>"
+        html_parts.append("</ul>")
 
-    html_body += """
-        <p>ダウンロードリンクは24時間有効です。期限が切れた場合は、アプリから再度復元をリクエストしてください。</p>
-
-        <div class="footer">
-          <p>※このメールは自動送信されています。ご返信いただいても対応できません。</p>
-        </div>
-      </div>
-    </body>
-    </html>
-    """
+    html_parts.append(HTML_EMAIL_FOOTER)
+    html_body = "".join(html_parts)
 
     # プレーンテキスト版の本文
-    text_body = f"""
-写真の復元が完了しました
-
-リクエストいただいた以下のファイルの復元が完了しました：
-
-"""
+    text_parts = [TEXT_EMAIL_HEADER]
 
     for i, key in enumerate(file_keys):
         file_name = key.split('/')[-1]
-        text_body += f"- {file_name}: {urls[i]}\n"
+        text_parts.append(f"- {file_name}: {urls[i]}\n")
 
     if len(file_keys) > 1 and urls[-1] != urls[-2]:
-        text_body += f"\nすべてのファイルを一括ダウンロード: {urls[-1]}\n"
+        text_parts.append(f"\nすべてのファイルを一括ダウンロード: {urls[-1]}\n")
 
-    text_body += """
-ダウンロードリンクは24時間有効です。期限が切れた場合は、アプリから再度復元をリクエストしてください。
-
-※このメールは自動送信されています。ご返信いただいても対応できません。
-    """
-
-    # MIMEマルチパートメッセージの作成
-    message = MIMEMultipart('alternative')
-    message['Subject'] = subject
-    message['From'] = SENDER_EMAIL
-    message['To'] = email
-
-    # テキストとHTML部分を追加
-    message.attach(MIMEText(text_body, 'plain'))
-    message.attach(MIMEText(html_body, 'html'))
+    text_parts.append(TEXT_EMAIL_FOOTER)
+    text_body = "".join(text_parts)
 
     try:
-        # SESでメール送信
-        response = ses_client.send_raw_email(
+        # SESでメール送信（添付ファイルがないためMIMEを組み立てずsend_emailを使用）
+        response = ses_client.send_email(
             Source=SENDER_EMAIL,
-            Destinations=[email],
-            RawMessage={'Data': message.as_string()}
+            Destination={'ToAddresses': [email]},
+            Message={
+                'Subject': {'Data': EMAIL_SUBJECT, 'Charset': 'UTF-8'},
+                'Body': {
+                    'Text': {'Data': text_body, 'Charset': 'UTF-8'},
+                    'Html': {'Data': html_body, 'Charset': 'UTF-8'}
+                }
+            }
         )
         logger.info(f"メール送信成功: {response['MessageId']}")
         return True
@@ -217,13 +445,89 @@ def send_notification_email(email, file_keys, urls):
         logger.error(f"メール送信エラー: {e}")
         return False
 
+def create_email_template():
+    """
+    一括送信用のSESテンプレートを登録（既に存在する場合は更新）
+    デプロイ時に一度実行する
+    """
+    try:
+        ses_client.create_template(Template=EMAIL_TEMPLATE)
+    except ses_client.exceptions.AlreadyExistsException:
+        ses_client.update_template(Template=EMAIL_TEMPLATE)
+
+def build_template_data(file_keys, urls):
+    """
+    SESテンプレートに埋め込むユーザーごとのデータを作成
+    """
+    files = [{'name': key.split('/')[-1], 'url': url} for key, url in zip(file_keys, urls)]
+    # 最後のURLが特別な場合（ZIPファイル）
+    zip_url = urls[-1] if len(file_keys) > 1 and urls[-1] != urls[-2] else ''
+    return {'files': files, 'zipUrl': zip_url}
+
+def send_notification_emails(notifications):
+    """
+    SESテンプレートを使い、最大50件ずつまとめて通知メールを送信
+    notifications: (メールアドレス, ファイルキー一覧, URL一覧) のリスト
+    戻り値: 送信に成功したメールアドレスのリスト
+    """
+    sent_emails = []
+    for i in range(0, len(notifications), SES_BULK_DESTINATION_LIMIT):
+        batch = notifications[i:i + SES_BULK_DESTINATION_LIMIT]
+        try:
+            response = ses_client.send_bulk_templated_email(
+                Source=SENDER_EMAIL,
+                Template=SES_TEMPLATE_NAME,
+                DefaultTemplateData=json.dumps({'files': [], 'zipUrl': ''}),
+                Destinations=[
+                    {
+                        'Destination': {'ToAddresses': [email]},
+                        'ReplacementTemplateData': json.dumps(build_template_data(file_keys, urls))
+                    }
+                    for email, file_keys, urls in batch
+                ]
+            )
+        except ClientError as e:
+            # テンプレート未登録などで一括送信できない場合は1件ずつ送信
+            logger.warning(f"一括メール送信に失敗したため個別に送信します: {e}")
+            for email, file_keys, urls in batch:
+                if send_notification_email(email, file_keys, urls):
+                    sent_emails.append(email)
+            continue
+
+        # 宛先ごとの送信結果を確認
+        for (email, _, _), status in zip(batch, response['Status']):
+            if status.get('Status') == 'Success':
+                logger.info(f"メール送信成功: {status.get('MessageId')}")
+                sent_emails.append(email)
+            else:
+                logger.error(f"メール送信エラー ({email}): {status.get('Status')} {status.get('Error', '')}")
+
+    return sent_emails
+
+def generate_notification_urls(keys):
+    """
+    1ユーザー分の復元完了ファイルの署名付きURL（複数ファイルの場合はZIPのURLを末尾に追加）を生成
+    """
+    # 各ファイルの署名付きURLを並列に生成
+    urls = [url for url in generate_presigned_urls(S3_BUCKET, keys) if url]
+
+    # 複数ファイルの場合、ZIPダウンロードURLも生成
+    if len(keys) > 1:
+        zip_url = create_download_zip_url(keys)
+        if zip_url:
+            urls.append(zip_url)
+
+    return urls
+
 def lambda_handler(event, context):
     """
     Lambda関数のメインハンドラー
     S3イベント通知から復元完了を検出し、ユーザーに通知
     """
     logger.info("S3 復元完了通知処理を開始")
-    logger.info(json.dumps(event))
+    # ログ出力が無効な場合はイベントのJSON変換自体を行わない
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("%s", json.dumps(event))
 
     try:
         # イベントレコードを処理
@@ -258,56 +562,57 @@ def lambda_handler(event, context):
                 'body': json.dumps('No restore completed events found')
             }
 
-        # ユーザーIDを取得（最初のキーから）
-        user_id = extract_user_id_from_key(restored_keys[0])
-        if not user_id:
-            logger.error(f"ユーザーIDが見つかりません: {restored_keys[0]}")
+        # キーをユーザーごとにグループ化
+        keys_by_user = defaultdict(list)
+        for key in restored_keys:
+            user_id = extract_user_id_from_key(key)
+            if not user_id:
+                logger.error(f"ユーザーIDが見つかりません: {key}")
+                continue
+            keys_by_user[user_id].append(key)
+
+        if not keys_by_user:
             return {
                 'statusCode': 400,
                 'body': json.dumps('User ID not found in object key')
             }
 
-        # ユーザーのメールアドレスを取得
-        email = get_user_email(user_id)
-        if not email:
-            logger.error(f"ユーザー {user_id} のメールアドレスが見つかりません")
+        # 全ユーザーのメールアドレスを一括取得
+        emails = get_user_emails(list(keys_by_user))
+        if not emails:
             return {
                 'statusCode': 400,
                 'body': json.dumps('User email not found')
             }
 
-        # 各ファイルの署名付きURLを生成
-        urls = []
-        for key in restored_keys:
-            url = generate_presigned_url(S3_BUCKET, key)
-            if url:
-                urls.append(url)
-
-        # 複数ファイルの場合、ZIPダウンロードURLも生成
-        if len(restored_keys) > 1:
-            zip_url = create_download_zip_url(restored_keys)
-            if zip_url:
-                urls.append(zip_url)
-
-        # メール送信
-        if email and urls:
-            success = send_notification_email(email, restored_keys, urls)
-            if success:
-                logger.info(f"通知メールをユーザー {user_id} ({email}) に送信しました")
-                return {
-                    'statusCode': 200,
-                    'body': json.dumps(f'Notification email sent to {email}')
-                }
-            else:
-                logger.error("通知メールの送信に失敗しました")
-                return {
-                    'statusCode': 500,
-                    'body': json.dumps('Failed to send notification email')
-                }
+        # ユーザーごとに自分のファイルのみの通知内容を作成
+        notifications = []
+        for user_id, user_keys in keys_by_user.items():
+            email = emails.get(user_id)
+            if not email:
+                logger.error(f"ユーザー {user_id} のメールアドレスが見つかりません")
+                continue
+
+            urls = generate_notification_urls(user_keys)
+            if not urls:
+                logger.error(f"ユーザー {user_id} の署名付きURLの生成に失敗しました")
+                continue
+            notifications.append((email, user_keys, urls))
+
+        # 通知メールをまとめて送信
+        sent_emails = send_notification_emails(notifications)
+        for email in sent_emails:
+            logger.info(f"通知メールを {email} に送信しました")
+
+        if not sent_emails:
+            return {
+                'statusCode': 500,
+                'body': json.dumps('Failed to send notification email')
+            }
 
         return {
-            'statusCode': 400,
-            'body': json.dumps('Failed to generate presigned URLs or get user email')
+            'statusCode': 200,
+            'body': json.dumps(f'Notification email sent to {", ".join(sent_emails)}')
         }
 
     except Exception as e:
@@ -6,22 +6,59 @@ Python 3.9 + PIL/Pillow実装版（rawpy依存なし）
 
 import json
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 import os
 import logging
 import io
+import struct
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus
 from typing import Dict, Any, Optional, List, Tuple
-from PIL import Image, ImageOps
+from PIL import Image, ImageDraw
 
 # ロギング設定
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# S3クライアント初期化
-s3_client = boto3.client('s3')
+# libjpeg-turbo（PyTurboJPEG）が利用可能な場合はJPEGのデコード・エンコードに使用
+# 利用できない環境ではPillowのみで処理する
+# Lambdaレイヤーではlibturbojpegを/opt/libに同梱している（見つからない場合はPyTurboJPEGの既定の探索に任せる）
+TURBOJPEG_LIB_PATH = os.environ.get('TURBOJPEG_LIB_PATH', '/opt/lib/libturbojpeg.so.0')
+try:
+    import numpy as np
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    turbo_jpeg = TurboJPEG(TURBOJPEG_LIB_PATH if os.path.exists(TURBOJPEG_LIB_PATH) else None)
+except Exception as e:
+    logger.info(f"PyTurboJPEGを使用できないためPillowで処理します: {e}")
+    turbo_jpeg = None
+
+# jpegtran-cffiが利用可能な場合はExifの向きに基づく回転をDCT係数上で可逆に行う
+try:
+    from jpegtran import JPEGImage
+except Exception as e:
+    logger.info(f"jpegtran-cffiを使用できないため回転はデコード後に行います: {e}")
+    JPEGImage = None
+
+# 並列に処理するS3イベントレコード数の上限（全体取得時は各レコードがRAWファイル全体をメモリに保持する）
+MAX_RECORD_WORKERS = int(os.environ.get('MAX_RECORD_WORKERS', '4'))
+# RAWファイル全体を取得する際の1レコードあたりの並列範囲GET数
+RAW_DOWNLOAD_CONCURRENCY = int(os.environ.get('RAW_DOWNLOAD_CONCURRENCY', '4'))
 
-# サポートするRAW拡張子のリスト
-RAW_EXTENSIONS = [
+# S3クライアント初期化
+# ウォーム起動間で接続（TLSセッション）を再利用し、リージョンも明示して解決処理を省く
+# 接続プールは全レコードが同時に並列範囲GETを行っても不足しない大きさにする
+s3_client = boto3.client('s3', region_name=os.environ.get('AWS_REGION'), config=Config(
+    max_pool_connections=MAX_RECORD_WORKERS * RAW_DOWNLOAD_CONCURRENCY,
+    retries={'max_attempts': 2, 'mode': 'standard'},
+    s3={'addressing_style': 'virtual'},
+    signature_version='s3v4',
+    tcp_keepalive=True
+))
+
+# サポートするRAW拡張子
+RAW_EXTENSIONS = frozenset({
     '.arw',  # Sony
     '.cr2', '.cr3',  # Canon
     '.dng',  # Adobe DNG
@@ -43,7 +80,88 @@ RAW_EXTENSIONS = [
     '.erf',  # Epson
     '.mos',  # Leaf
     '.rwz',  # Rawzor
-]
+})
+
+# str.endswithでまとめて判定するためのタプル
+RAW_EXTENSION_SUFFIXES = tuple(RAW_EXTENSIONS)
+
+# Exifの向き（Orientation）タグと、正しい向きに戻すための変換
+EXIF_ORIENTATION_TAG = 0x0112
+EXIF_ORIENTATION_TRANSPOSE = {
+    2: Image.FLIP_LEFT_RIGHT,
+    3: Image.ROTATE_180,
+    4: Image.FLIP_TOP_BOTTOM,
+    5: Image.TRANSPOSE,
+    6: Image.ROTATE_270,
+    7: Image.TRANSVERSE,
+    8: Image.ROTATE_90,
+}
+
+# 埋め込みプレビューの位置を探すために参照するTIFFタグ
+TIFF_TAG_NEW_SUBFILE_TYPE = 0x00FE
+TIFF_TAG_COMPRESSION = 0x0103
+TIFF_TAG_STRIP_OFFSETS = 0x0111
+TIFF_TAG_STRIP_BYTE_COUNTS = 0x0117
+TIFF_TAG_SUB_IFDS = 0x014A
+TIFF_TAG_JPEG_OFFSET = 0x0201  # JPEGInterchangeFormat
+TIFF_TAG_JPEG_LENGTH = 0x0202  # JPEGInterchangeFormatLength
+TIFF_TAG_PANASONIC_JPEG = 0x002E  # RW2のJpgFromRaw（値そのものがJPEG）
+TIFF_PREVIEW_TAGS = frozenset((
+    TIFF_TAG_NEW_SUBFILE_TYPE, TIFF_TAG_COMPRESSION,
+    TIFF_TAG_STRIP_OFFSETS, TIFF_TAG_STRIP_BYTE_COUNTS,
+    TIFF_TAG_SUB_IFDS, TIFF_TAG_JPEG_OFFSET, TIFF_TAG_JPEG_LENGTH,
+    TIFF_TAG_PANASONIC_JPEG,
+))
+# IFDエントリの型ごとのstructフォーマット（BYTE, SHORT, LONG, UNDEFINED, IFD）
+TIFF_TYPE_FORMATS = {1: 'B', 3: 'H', 4: 'I', 7: 'B', 13: 'I'}
+TIFF_TYPE_UNDEFINED = 7
+# JPEG圧縮を表すCompressionの値
+TIFF_JPEG_COMPRESSIONS = frozenset((6, 7))
+
+# RAF（Fuji）のヘッダー: 84〜87バイト目がJPEGのオフセット、88〜91バイト目が長さ（ビッグエンディアン）
+RAF_MAGIC = b'FUJIFILMCCD-RAW'
+RAF_JPEG_LOCATION_OFFSET = 84
+# X3F（Sigma）: ファイル末尾4バイトがセクションディレクトリの位置
+X3F_MAGIC = b'FOVb'
+X3F_IMAGE_SECTION_TYPES = frozenset((b'IMA2', b'IMAG'))
+X3F_IMAGE_FORMAT_JPEG = 18
+X3F_IMAGE_HEADER_SIZE = 28
+
+# IFD解析のために範囲取得するRAWファイル先頭のサイズ
+RAW_HEADER_RANGE_SIZE = 64 * 1024
+# プレビュー候補のSOFを確認するために範囲取得する先頭のサイズ（Exifを含むAPP1セグメントも収まる大きさ）
+PREVIEW_HEADER_RANGE_SIZE = 128 * 1024
+# 範囲取得を行わずファイル全体を取得する拡張子
+# （TIFFは画像本体、X3F・CR3（ISO-BMFF）・MRWはTIFF形式のヘッダーを持たないため）
+FULL_READ_EXTENSIONS = frozenset(('.tiff', '.tif', '.x3f', '.cr3', '.mrw'))
+
+# RAWファイル全体を取得する際の並列範囲GET設定（8MB単位）
+RAW_DOWNLOAD_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=RAW_DOWNLOAD_CONCURRENCY,
+    use_threads=True
+)
+
+# 画像サイズを格納するJPEGのSOFマーカー（DHT・JPG・DACを除くC0〜CF）
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# 長さフィールドを持たない単独マーカー（TEM, RST0〜RST7）
+JPEG_STANDALONE_MARKERS = frozenset([0x01] + list(range(0xD0, 0xD8)))
+JPEG_SOS_MARKER = 0xDA
+JPEG_APP1_MARKER = 0xE1
+
+# 埋め込みJPEGの開始マーカーを検索する範囲（先頭からのバイト数、見つからなければ順に広げる）
+JPEG_SEARCH_WINDOWS = (2 * 1024 * 1024, 4 * 1024 * 1024, 8 * 1024 * 1024, 16 * 1024 * 1024)
+
+# プレビューとして使用できるSOFマーカー（ベースライン・拡張・プログレッシブ）
+# ロスレス（C3）などはセンサーデータ本体の圧縮に使われるため除外する
+JPEG_PREVIEW_SOF_MARKERS = frozenset((0xC0, 0xC1, 0xC2))
+
+# サムネイルの最大サイズ（長辺）
+THUMBNAIL_MAX_SIZE = 1200
+
+# JPEGデコード時に指定できる縮小率の分母（大きい順）
+JPEG_DRAFT_SCALES = (8, 4, 2)
 
 def get_file_extension(filename: str) -> str:
     """ファイルの拡張子を取得"""
@@ -51,13 +169,13 @@ def get_file_extension(filename: str) -> str:
 
 def is_raw_file(filename: str) -> bool:
     """RAWファイルかどうかを判定"""
-    extension = get_file_extension(filename)
-    return extension in RAW_EXTENSIONS
+    return filename.lower().endswith(RAW_EXTENSION_SUFFIXES)
 
 def extract_path_info(key: str) -> Optional[Dict[str, str]]:
     """S3パスからユーザーIDと日付情報を抽出"""
     # パスの例: user/abc123/raw/2023/04/15/file.x3f
-    path_parts = key.split('/')
+    # 必要なのは先頭6階層のみのため、それ以降は分割しない
+    path_parts = key.split('/', 6)
     if len(path_parts) < 7:  # 必要な階層が足りない
         logger.warning(f"無効なパス形式: {key}")
         return None
@@ -69,8 +187,8 @@ def extract_path_info(key: str) -> Optional[Dict[str, str]]:
         month = path_parts[4]
         day = path_parts[5]
 
-        # 数値形式の検証
-        if not (year.isdigit() and month.isdigit() and day.isdigit()):
+        # 数値形式の検証（全角数字などASCII以外の数字は除外）
+        if not (year.isdigit() and month.isdigit() and day.isdigit() and (year + month + day).isascii()):
             logger.warning(f"パスの日付部分が数値ではありません: {key}")
             return None
 
@@ -96,6 +214,130 @@ def generate_thumbnail_path(source_key: str, filename: str) -> Optional[str]:
     # サムネイル保存先のパスを生成
     return f"user/{path_info['user_id']}/rawThumbnail/{path_info['year']}/{path_info['month']}/{path_info['day']}/{thumbnail_filename}"
 
+def read_tiff_ifd(data: bytes, offset: int, endian: str) -> Tuple[Dict[int, Tuple[int, ...]], int]:
+    """IFDからプレビュー検出に必要なタグのみを読み取り、(タグ値, 次のIFDのオフセット)を返す
+    UNDEFINED型のタグは値の代わりに(データ位置, 長さ)を格納する
+    """
+    entry_count = struct.unpack_from(endian + 'H', data, offset)[0]
+    entries_end = offset + 2 + entry_count * 12
+    if entries_end > len(data):
+        return {}, 0
+
+    tags = {}
+    for pos in range(offset + 2, entries_end, 12):
+        tag, field_type, count = struct.unpack_from(endian + 'HHI', data, pos)
+        type_format = TIFF_TYPE_FORMATS.get(field_type)
+        if tag not in TIFF_PREVIEW_TAGS or type_format is None or count == 0:
+            continue
+
+        # 4バイト以内の値はエントリ内に直接格納されている
+        value_size = struct.calcsize(type_format) * count
+        value_pos = pos + 8 if value_size <= 4 else struct.unpack_from(endian + 'I', data, pos + 8)[0]
+
+        if field_type == TIFF_TYPE_UNDEFINED:
+            tags[tag] = (value_pos, count)
+        elif value_pos + value_size <= len(data):
+            tags[tag] = struct.unpack_from(f"{endian}{count}{type_format}", data, value_pos)
+
+    next_ifd = 0
+    if entries_end + 4 <= len(data):
+        next_ifd = struct.unpack_from(endian + 'I', data, entries_end)[0]
+    return tags, next_ifd
+
+def find_tiff_jpeg_previews(data: bytes) -> List[Tuple[int, int]]:
+    """TIFFベースのRAWのIFDを辿り、埋め込みJPEGプレビューの位置（オフセット, 長さ）の一覧を取得
+    dataはファイル先頭からの部分データでもよい（範囲外のIFDは無視する）
+    """
+    if data[:2] == b'II':
+        endian = '<'
+    elif data[:2] == b'MM':
+        endian = '>'
+    else:
+        return []
+
+    if len(data) < 8:
+        return []
+
+    candidates = []
+    pending = [(struct.unpack_from(endian + 'I', data, 4)[0], True)]
+    visited = set()
+
+    while pending:
+        ifd_offset, is_ifd0 = pending.pop()
+        if ifd_offset in visited or ifd_offset + 2 > len(data):
+            continue
+        visited.add(ifd_offset)
+
+        tags, next_ifd = read_tiff_ifd(data, ifd_offset, endian)
+
+        # JPEGInterchangeFormat / JPEGInterchangeFormatLength（NEF, ARW, CR2のIFD1など）
+        if TIFF_TAG_JPEG_OFFSET in tags and TIFF_TAG_JPEG_LENGTH in tags:
+            candidates.append((tags[TIFF_TAG_JPEG_OFFSET][0], tags[TIFF_TAG_JPEG_LENGTH][0]))
+
+        # JPEG圧縮の単一ストリップ（CR2のIFD0, DNGの縮小画像）
+        # センサーデータ本体もJPEG圧縮の場合があるため、IFD0か縮小画像のIFDに限定する
+        compression = tags.get(TIFF_TAG_COMPRESSION, (1,))[0]
+        is_reduced = tags.get(TIFF_TAG_NEW_SUBFILE_TYPE, (0,))[0] == 1
+        strip_offsets = tags.get(TIFF_TAG_STRIP_OFFSETS, ())
+        strip_byte_counts = tags.get(TIFF_TAG_STRIP_BYTE_COUNTS, ())
+        if (compression in TIFF_JPEG_COMPRESSIONS and (is_ifd0 or is_reduced)
+                and len(strip_offsets) == 1 and len(strip_byte_counts) == 1):
+            candidates.append((strip_offsets[0], strip_byte_counts[0]))
+
+        # RW2のJpgFromRaw
+        if TIFF_TAG_PANASONIC_JPEG in tags:
+            candidates.append(tags[TIFF_TAG_PANASONIC_JPEG])
+
+        for sub_ifd in tags.get(TIFF_TAG_SUB_IFDS, ()):
+            pending.append((sub_ifd, False))
+        if next_ifd:
+            pending.append((next_ifd, False))
+
+    return [(offset, length) for offset, length in candidates if offset > 0 and length > 0]
+
+def find_raf_jpeg_preview(data: bytes) -> Optional[Tuple[int, int]]:
+    """RAF（Fuji）の固定ヘッダーから埋め込みJPEGの位置（オフセット, 長さ）を取得"""
+    if not data.startswith(RAF_MAGIC) or len(data) < RAF_JPEG_LOCATION_OFFSET + 8:
+        return None
+    return struct.unpack_from('>II', data, RAF_JPEG_LOCATION_OFFSET)
+
+def find_x3f_jpeg_preview(data: bytes) -> Optional[Tuple[int, int]]:
+    """X3F（Sigma）のセクションディレクトリから埋め込みJPEGの位置（オフセット, 長さ）を取得"""
+    if not data.startswith(X3F_MAGIC) or len(data) < 8:
+        return None
+
+    try:
+        directory = struct.unpack_from('<I', data, len(data) - 4)[0]
+        if data[directory:directory + 4] != b'SECd':
+            return None
+
+        entry_count = struct.unpack_from('<I', data, directory + 8)[0]
+        for pos in range(directory + 12, directory + 12 + entry_count * 12, 12):
+            offset, length, section_type = struct.unpack_from('<II4s', data, pos)
+            if section_type not in X3F_IMAGE_SECTION_TYPES or data[offset:offset + 4] != b'SECi':
+                continue
+
+            # 画像セクションのヘッダー（SECi, バージョン, 種類, 形式, 幅, 高さ, 行サイズ）の後にデータが続く
+            if struct.unpack_from('<I', data, offset + 12)[0] == X3F_IMAGE_FORMAT_JPEG:
+                return offset + X3F_IMAGE_HEADER_SIZE, length - X3F_IMAGE_HEADER_SIZE
+        return None
+    except struct.error:
+        return None
+
+def covers_thumbnail_size(candidate: Tuple[int, int, int, int]) -> bool:
+    """(幅, 高さ, 開始位置, 終了位置)の候補がサムネイルの最大サイズに届くか（縮小のみで作成できるか）"""
+    return max(candidate[0], candidate[1]) >= THUMBNAIL_MAX_SIZE
+
+def select_jpeg_preview(candidates: List[Tuple[int, int, int, int]]) -> Tuple[int, int, int, int]:
+    """(幅, 高さ, 開始位置, 終了位置)の候補からサムネイルに使うJPEGを選択
+    サムネイルの最大サイズ以上のうち最小のもの（縮小のみで済み、処理量が最も少ない）、
+    なければ最大のものを選ぶ
+    """
+    covering = [candidate for candidate in candidates if covers_thumbnail_size(candidate)]
+    if covering:
+        return min(covering, key=lambda candidate: candidate[0] * candidate[1])
+    return max(candidates, key=lambda candidate: candidate[0] * candidate[1])
+
 def find_jpeg_data_in_raw(raw_data: bytes) -> Optional[bytes]:
     """RAWデータ内のJPEGデータを検索する"""
     # JPEGマーカーのパターン
@@ -103,35 +345,276 @@ def find_jpeg_data_in_raw(raw_data: bytes) -> Optional[bytes]:
     jpeg_end = b'\xff\xd9'
 
     try:
-        # JPEGの開始マーカーを検索
-        start_pos = raw_data.find(jpeg_start)
-        if start_pos == -1:
-            logger.info("JPEGマーカーが見つかりません")
+        # TIFFベースのRAWはIFDからプレビューの位置を直接取得し、SOFのサイズで選択する
+        candidates = []
+        for offset, length in find_tiff_jpeg_previews(raw_data):
+            header = scan_jpeg_header(raw_data, offset)
+            if header and header['sof_marker'] in JPEG_PREVIEW_SOF_MARKERS and offset + length <= len(raw_data):
+                candidates.append((header['width'], header['height'], offset, offset + length))
+
+        # サムネイルサイズに届く候補があればそれを使う
+        if any(covers_thumbnail_size(candidate) for candidate in candidates):
+            width, height, start_pos, end_pos = select_jpeg_preview(candidates)
+            logger.info(f"IFDからJPEGデータ検出: {width}x{height}, {end_pos - start_pos}バイト")
+            return raw_data[start_pos:end_pos]
+
+        # 届かない場合（大きなプレビューがMakerNote内にあるORF・PEFなど）は全体を検索して候補に加える
+        # JPEGの開始マーカーを先頭から段階的に範囲を広げて検索（プレビューは通常ファイル先頭付近にある）
+        start_pos = -1
+        searched_end = 0
+        for window_end in JPEG_SEARCH_WINDOWS + (len(raw_data),):
+            # 前回の範囲の境界をまたぐマーカーも検出できるよう少し重ねて検索
+            search_start = max(0, searched_end - len(jpeg_start) + 1)
+            start_pos = raw_data.find(jpeg_start, search_start, window_end)
+            searched_end = window_end
+            if start_pos != -1 or window_end >= len(raw_data):
+                break
+
+        # 最初のマーカーを見つけた範囲内にある全てのJPEGを候補として収集
+        # 終了マーカーは画像データ（SOS）以降から検索し、Exif内の縮小画像で途切れないようにする
+        while start_pos != -1:
+            header = scan_jpeg_header(raw_data, start_pos)
+            end_pos = -1
+            if header and header['sof_marker'] in JPEG_PREVIEW_SOF_MARKERS:
+                end_pos = raw_data.find(jpeg_end, header['scan_start'])
+
+            if end_pos == -1:
+                start_pos = raw_data.find(jpeg_start, start_pos + 1, searched_end)
+                continue
+
+            # 終了マーカーも含める
+            candidates.append((header['width'], header['height'], start_pos, end_pos + 2))
+            start_pos = raw_data.find(jpeg_start, end_pos + 2, searched_end)
+
+        if not candidates:
+            logger.info("有効なJPEGデータが見つかりません")
             return None
 
-        # JPEGの終了マーカーを検索
-        end_pos = raw_data.find(jpeg_end, start_pos)
-        if end_pos == -1:
-            logger.info("JPEG終了マーカーが見つかりません")
+        # JPEGデータを切り出し（候補はマーカーの走査でSOI・SOF・EOIを確認済みのためデコードによる検証は不要）
+        width, height, start_pos, end_pos = select_jpeg_preview(candidates)
+        jpeg_data = raw_data[start_pos:end_pos]
+        logger.info(f"JPEGデータ検出: {width}x{height}, {len(jpeg_data)}バイト（候補{len(candidates)}件）")
+        return jpeg_data
+
+    except Exception as e:
+        logger.error(f"JPEG検索エラー: {e}")
+        return None
+
+def get_object_range(bucket: str, key: str, start: int, end: int) -> bytes:
+    """S3オブジェクトの指定範囲（start〜endバイト目）を取得"""
+    response = s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}")
+    return response['Body'].read()
+
+def fetch_embedded_preview(bucket: str, key: str) -> Optional[Tuple[int, bytes]]:
+    """RAWファイルの先頭のみを取得してIFDを解析し、埋め込みJPEGプレビューだけを範囲取得する
+    (RAWファイル内のオフセット, JPEGデータ)を返す
+    """
+    try:
+        header = get_object_range(bucket, key, 0, RAW_HEADER_RANGE_SIZE - 1)
+        previews = find_tiff_jpeg_previews(header)
+
+        # RAFはTIFF形式ではないが、ヘッダーの固定位置にプレビューの位置がある
+        raf_preview = find_raf_jpeg_preview(header)
+        if raf_preview:
+            previews.append(raf_preview)
+
+        if not previews:
+            logger.info("ヘッダーからプレビュー位置を取得できません")
             return None
 
-        # JPEGデータを切り出し（終了マーカーも含める）
-        jpeg_data = raw_data[start_pos:end_pos + 2]
-        logger.info(f"JPEGデータ検出: {len(jpeg_data)}バイト")
+        # 各候補の先頭のみを読んでSOFを確認し、センサーデータ（ロスレスJPEG）を全体取得しないようにする
+        candidates = []
+        prefixes = {}
+        for offset, length in previews:
+            prefix_end = offset + min(length, PREVIEW_HEADER_RANGE_SIZE)
+            if prefix_end <= len(header):
+                prefix = header[offset:prefix_end]
+            else:
+                prefix = get_object_range(bucket, key, offset, prefix_end - 1)
+
+            jpeg_header = scan_jpeg_header(prefix)
+            if jpeg_header and jpeg_header['sof_marker'] in JPEG_PREVIEW_SOF_MARKERS:
+                candidates.append((jpeg_header['width'], jpeg_header['height'], offset, offset + length))
+                prefixes[offset] = prefix
+
+        if not candidates:
+            logger.info("範囲取得したプレビュー候補に有効なJPEGがありません")
+            return None
 
-        # 有効なJPEGかチェック
-        try:
-            Image.open(io.BytesIO(jpeg_data))
-            return jpeg_data
-        except Exception as e:
-            logger.info(f"抽出したJPEGデータが無効です: {e}")
+        # サムネイルサイズに届く候補がない場合（大きなプレビューがMakerNote内にあるORF・PEFなど）は
+        # 全体取得してマーカーを検索させる
+        if not any(covers_thumbnail_size(candidate) for candidate in candidates):
+            logger.info("ヘッダーから取得できるプレビューがサムネイルサイズに届かないため全体を取得します")
             return None
 
+        # SOFのサイズで選択し、残りの部分のみを範囲取得する
+        width, height, start_pos, end_pos = select_jpeg_preview(candidates)
+        jpeg_data = prefixes[start_pos]
+        if start_pos + len(jpeg_data) < end_pos:
+            jpeg_data += get_object_range(bucket, key, start_pos + len(jpeg_data), end_pos - 1)
+
+        logger.info(f"範囲取得でJPEGデータ取得: オフセット={start_pos}, {width}x{height}, {len(jpeg_data)}バイト")
+        return start_pos, jpeg_data
     except Exception as e:
-        logger.error(f"JPEG検索エラー: {e}")
+        logger.warning(f"プレビューの範囲取得エラー（全体取得で続行）: {e}")
         return None
 
-def create_placeholder_thumbnail(width=1200, height=800) -> bytes:
+def copy_preview_to_thumbnail(bucket: str, key: str, thumbnail_key: str, offset: int, length: int, metadata: Dict[str, str]) -> None:
+    """RAWファイル内の埋め込みプレビューの範囲をサーバー側でコピーしてサムネイルとして保存
+    範囲指定のコピーはマルチパートアップロードでのみ可能なため、1パートのみのアップロードとして行う
+    """
+    upload_id = s3_client.create_multipart_upload(
+        Bucket=bucket,
+        Key=thumbnail_key,
+        ContentType='image/jpeg',
+        Metadata=metadata
+    )['UploadId']
+
+    try:
+        part = s3_client.upload_part_copy(
+            Bucket=bucket,
+            Key=thumbnail_key,
+            UploadId=upload_id,
+            PartNumber=1,
+            CopySource={'Bucket': bucket, 'Key': key},
+            CopySourceRange=f"bytes={offset}-{offset + length - 1}"
+        )
+        s3_client.complete_multipart_upload(
+            Bucket=bucket,
+            Key=thumbnail_key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': [{'ETag': part['CopyPartResult']['ETag'], 'PartNumber': 1}]}
+        )
+    except Exception:
+        s3_client.abort_multipart_upload(Bucket=bucket, Key=thumbnail_key, UploadId=upload_id)
+        raise
+
+def read_exif_orientation(exif_data: bytes) -> int:
+    """APP1セグメント内のExif（TIFF形式）からOrientationタグの値を取得"""
+    if exif_data[:2] == b'II':
+        endian = '<'
+    elif exif_data[:2] == b'MM':
+        endian = '>'
+    else:
+        return 1
+
+    ifd0 = struct.unpack_from(endian + 'I', exif_data, 4)[0]
+    entry_count = struct.unpack_from(endian + 'H', exif_data, ifd0)[0]
+    for pos in range(ifd0 + 2, ifd0 + 2 + entry_count * 12, 12):
+        tag = struct.unpack_from(endian + 'H', exif_data, pos)[0]
+        if tag == EXIF_ORIENTATION_TAG:
+            return struct.unpack_from(endian + 'H', exif_data, pos + 8)[0]
+    return 1
+
+def scan_jpeg_header(jpeg_data: bytes, start: int = 0) -> Optional[Dict[str, int]]:
+    """JPEGのヘッダー部のマーカーを走査し、デコードせずに画像情報を取得
+    幅・高さ・Exifの向き・SOFマーカーの種類・画像データ（SOS）の位置を返す
+    """
+    if jpeg_data[start:start + 2] != b'\xff\xd8':
+        return None
+
+    try:
+        info = {'orientation': 1}
+        pos = start + 2
+        while pos + 4 <= len(jpeg_data):
+            if jpeg_data[pos] != 0xFF:
+                return None
+
+            marker = jpeg_data[pos + 1]
+            if marker == 0xFF:
+                # フィルバイト
+                pos += 1
+                continue
+            if marker in JPEG_STANDALONE_MARKERS:
+                pos += 2
+                continue
+            if marker == JPEG_SOS_MARKER:
+                # SOFより前に画像データが始まった場合は不正
+                if 'sof_marker' not in info:
+                    return None
+                info['scan_start'] = pos
+                return info
+
+            segment_length = struct.unpack_from('>H', jpeg_data, pos + 2)[0]
+            if marker in JPEG_SOF_MARKERS:
+                info['sof_marker'] = marker
+                info['height'], info['width'] = struct.unpack_from('>HH', jpeg_data, pos + 5)
+            elif marker == JPEG_APP1_MARKER and jpeg_data[pos + 4:pos + 10] == b'Exif\x00\x00':
+                info['orientation'] = read_exif_orientation(jpeg_data[pos + 10:pos + 2 + segment_length])
+
+            pos += 2 + segment_length
+        return None
+    except struct.error:
+        return None
+
+def read_jpeg_info(jpeg_data: bytes) -> Optional[Tuple[int, int, int]]:
+    """JPEGのマーカーを走査し、デコードせずに(幅, 高さ, Exifの向き)を取得"""
+    header = scan_jpeg_header(jpeg_data)
+    if not header:
+        return None
+    return header['width'], header['height'], header['orientation']
+
+def transpose_jpeg_losslessly(jpeg_data: bytes) -> Optional[bytes]:
+    """Exifの向きに従ってJPEGを可逆変換（デコード・再エンコードせず、向きは1に更新される）"""
+    if JPEGImage is None:
+        return None
+
+    try:
+        return JPEGImage(blob=jpeg_data).exif_autotransform().as_blob()
+    except Exception as e:
+        logger.info(f"jpegtranでの回転に失敗したためデコード後に回転します: {e}")
+        return None
+
+def get_draft_scale(width: int, height: int, max_width: int, max_height: int) -> int:
+    """リサイズ後のサイズを下回らない範囲で、JPEGデコード時の縮小率の分母（1/2・1/4・1/8）を決定"""
+    ratio = min(max_width / width, max_height / height)
+    if ratio >= 1:
+        return 1
+
+    # アスペクト比を維持したリサイズ後のサイズに対して何分の1まで縮小できるか
+    target_width = max(1, int(width * ratio))
+    target_height = max(1, int(height * ratio))
+    scale = min(width // target_width, height // target_height)
+
+    for denominator in JPEG_DRAFT_SCALES:
+        if scale >= denominator:
+            return denominator
+    return 1
+
+def decode_jpeg(jpeg_data: bytes, scale: int = 1) -> Image.Image:
+    """JPEGデータをデコード（libjpeg-turboが使えない・失敗した場合はPillowを使用）
+    scaleを指定した場合はデコード時に1/scaleへ縮小する（DCT段階での縮小）
+    """
+    if turbo_jpeg:
+        try:
+            scaling_factor = (1, scale) if scale > 1 else None
+            return Image.fromarray(turbo_jpeg.decode(jpeg_data, pixel_format=TJPF_RGB, scaling_factor=scaling_factor))
+        except Exception as e:
+            logger.info(f"turbojpegでのデコードに失敗したためPillowで処理します: {e}")
+
+    img = Image.open(io.BytesIO(jpeg_data))
+    if scale > 1:
+        # load()前にdraftを指定し、libjpegに縮小デコードさせる
+        img.draft('RGB', (img.width // scale, img.height // scale))
+    img.load()
+    return img
+
+def encode_jpeg(img: Image.Image, quality: int = 85) -> bytes:
+    """画像をJPEGにエンコード（libjpeg-turboが使えない・失敗した場合はPillowを使用）"""
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    if turbo_jpeg:
+        try:
+            return turbo_jpeg.encode(np.asarray(img), quality=quality, pixel_format=TJPF_RGB)
+        except Exception as e:
+            logger.info(f"turbojpegでのエンコードに失敗したためPillowで処理します: {e}")
+
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+def build_placeholder_thumbnail(width: int, height: int) -> bytes:
     """RAWファイルからサムネイルを抽出できない場合のプレースホルダー画像を生成"""
     try:
         # プレースホルダー画像の作成（グレースケール）
@@ -145,7 +628,8 @@ def create_placeholder_thumbnail(width=1200, height=800) -> bytes:
             # デフォルトのフォントでテキスト描画（フォントサイズは環境によって異なる）
             font_size = width // 8
             text = "RAW"
-            text_width, text_height = draw.textsize(text)
+            left, top, right, bottom = draw.textbbox((0, 0), text)
+            text_width, text_height = right - left, bottom - top
             position = ((width - text_width) // 2, (height - text_height) // 2)
             draw.text(position, text, fill=(150, 150, 150))
         except Exception as e:
@@ -154,7 +638,6 @@ def create_placeholder_thumbnail(width=1200, height=800) -> bytes:
         # 画像をバイトストリームに変換
         buffer = io.BytesIO()
         img.save(buffer, format='JPEG', quality=85)
-        buffer.seek(0)
         return buffer.getvalue()
     except Exception as e:
         logger.error(f"プレースホルダー画像生成エラー: {e}")
@@ -162,9 +645,18 @@ def create_placeholder_thumbnail(width=1200, height=800) -> bytes:
         img = Image.new('RGB', (400, 300), (200, 200, 200))
         buffer = io.BytesIO()
         img.save(buffer, format='JPEG', quality=80)
-        buffer.seek(0)
         return buffer.getvalue()
 
+# 既定サイズのプレースホルダーは起動時に一度だけ生成して使い回す
+PLACEHOLDER_SIZE = (1200, 800)
+PLACEHOLDER_THUMBNAIL = build_placeholder_thumbnail(*PLACEHOLDER_SIZE)
+
+def create_placeholder_thumbnail(width=1200, height=800) -> bytes:
+    """プレースホルダー画像を取得（既定サイズの場合は生成済みのデータを返す）"""
+    if (width, height) == PLACEHOLDER_SIZE:
+        return PLACEHOLDER_THUMBNAIL
+    return build_placeholder_thumbnail(width, height)
+
 def process_tiff_file(raw_data: bytes) -> Optional[bytes]:
     """TIFFファイルからサムネイルを抽出"""
     try:
@@ -179,10 +671,7 @@ def process_tiff_file(raw_data: bytes) -> Optional[bytes]:
         img.thumbnail((1200, 1200), Image.LANCZOS)
 
         # JPEGとして保存
-        buffer = io.BytesIO()
-        img.save(buffer, format='JPEG', quality=85)
-        buffer.seek(0)
-        return buffer.getvalue()
+        return encode_jpeg(img)
     except Exception as e:
         logger.error(f"TIFF処理エラー: {e}")
         return None
@@ -194,7 +683,23 @@ def process_raw_file(raw_data: bytes, extension: str) -> bytes:
     try:
         logger.info(f"RAW処理開始: 形式={extension}, サイズ={len(raw_data)}バイト")
 
-        # まずRAWファイル内のJPEGデータを検索
+        # TIFF形式ではないRAF・X3Fはヘッダー・ディレクトリからプレビューの位置を直接取得する
+        preview = None
+        if extension == '.raf':
+            preview = find_raf_jpeg_preview(raw_data)
+        elif extension == '.x3f':
+            preview = find_x3f_jpeg_preview(raw_data)
+
+        if preview:
+            offset, length = preview
+            jpeg_data = raw_data[offset:offset + length]
+            header = scan_jpeg_header(jpeg_data)
+            if header and header['sof_marker'] in JPEG_PREVIEW_SOF_MARKERS:
+                logger.info(f"{extension}のヘッダーからJPEGデータ検出: {header['width']}x{header['height']}, {length}バイト")
+                return jpeg_data
+            logger.info("ヘッダーのプレビュー位置が無効なため全体を検索します")
+
+        # RAWファイル内のJPEGデータを検索
         jpeg_data = find_jpeg_data_in_raw(raw_data)
         if jpeg_data:
             logger.info("RAWファイルからJPEGデータの抽出に成功")
@@ -215,15 +720,34 @@ def process_raw_file(raw_data: bytes, extension: str) -> bytes:
         return create_placeholder_thumbnail()
 
 def optimize_thumbnail(thumb_data: bytes, max_width: int = 1200, max_height: int = 1200) -> bytes:
-    """サムネイルの最適化（大きすぎる場合のリサイズ）"""
+    """サムネイルの最適化（大きすぎる場合のリサイズ、Exifの向きに基づく回転）
+    サイズ・向きとも問題ない場合は元のデータをそのまま返す
+    """
     try:
-        # データが既に最適化されている場合は、そのまま返す
-        if len(thumb_data) < 100 * 1024:  # 100KB未満はそのまま返す
+        # サイズとExifの向きはJPEGのマーカーから取得（解析できない場合はPillowでヘッダーのみ読む）
+        jpeg_info = read_jpeg_info(thumb_data)
+        if jpeg_info:
+            width, height, orientation = jpeg_info
+        else:
+            with Image.open(io.BytesIO(thumb_data)) as header:
+                width, height = header.size
+                orientation = header.getexif().get(EXIF_ORIENTATION_TAG, 1)
+
+        # 回転が必要な場合は先に可逆変換し、画素上での回転を不要にする
+        if orientation != 1:
+            transposed_data = transpose_jpeg_losslessly(thumb_data)
+            transposed_info = read_jpeg_info(transposed_data) if transposed_data else None
+            # Exifの向きが1に更新されていない場合は二重に回転されるため、変換結果を使わない
+            if transposed_info and transposed_info[2] == 1:
+                thumb_data = transposed_data
+                width, height, orientation = transposed_info
+
+        # リサイズも回転も不要な場合は再エンコードせずそのまま返す
+        if width <= max_width and height <= max_height and orientation == 1:
             return thumb_data
 
-        # PILを使ってリサイズが必要かチェック
-        img = Image.open(io.BytesIO(thumb_data))
-        width, height = img.size
+        # 画素データをデコード（リサイズが必要な場合は縮小デコード）
+        img = decode_jpeg(thumb_data, get_draft_scale(width, height, max_width, max_height))
 
         # 最大サイズを超えている場合のみリサイズ
         if width > max_width or height > max_height:
@@ -232,35 +756,24 @@ def optimize_thumbnail(thumb_data: bytes, max_width: int = 1200, max_height: int
             # アスペクト比を維持してリサイズ
             img.thumbnail((max_width, max_height), Image.LANCZOS)
 
-            # 画像を回転（Exif情報に基づく）
-            img = ImageOps.exif_transpose(img)
-
-            # 最適化して保存
-            buffer = io.BytesIO()
-            img.save(buffer, format='JPEG', quality=85, optimize=True)
-            buffer.seek(0)
-            return buffer.getvalue()
-        else:
-            # 画像を回転（Exif情報に基づく）
-            img = ImageOps.exif_transpose(img)
+        # 画像を回転（Exif情報に基づく）
+        transpose_method = EXIF_ORIENTATION_TRANSPOSE.get(orientation)
+        if transpose_method is not None:
+            img = img.transpose(transpose_method)
 
-            # 最適化して保存
-            buffer = io.BytesIO()
-            img.save(buffer, format='JPEG', quality=85, optimize=True)
-            buffer.seek(0)
-            return buffer.getvalue()
+        # 最適化して保存
+        return encode_jpeg(img)
     except Exception as e:
         logger.error(f"サムネイル最適化エラー: {e}")
         return thumb_data  # エラー時は元のデータをそのまま返す
 
-def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
-    """Lambda関数ハンドラー"""
-    logger.info(f"S3イベント受信: {json.dumps(event)}")
-
+def process_record(record: Dict[str, Any]) -> Dict[str, Any]:
+    """S3イベントの1レコード分のRAWファイルからサムネイルを生成"""
     try:
         # イベントからS3情報を取得
-        bucket = event['Records'][0]['s3']['bucket']['name']
-        key = event['Records'][0]['s3']['object']['key'].replace('%3A', ':').replace('%2B', '+').replace('%20', ' ')
+        bucket = record['s3']['bucket']['name']
+        # S3イベントのキーはURLエンコードされている（スペースは「+」）
+        key = unquote_plus(record['s3']['object']['key'])
 
         # ファイル名を取得
         filename = os.path.basename(key)
@@ -285,19 +798,48 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
 
         logger.info(f"サムネイル保存先: {thumbnail_key}")
 
-        # S3からRAWファイルを取得
-        response = s3_client.get_object(Bucket=bucket, Key=key)
-        raw_data = response['Body'].read()
-
         # ファイルの拡張子を取得
         extension = get_file_extension(filename)
 
-        # RAWファイルからサムネイルを抽出
-        thumbnail_data = process_raw_file(raw_data, extension)
+        # TIFFベースのRAWはヘッダーと埋め込みプレビューのみを範囲取得する
+        preview = None
+        if extension not in FULL_READ_EXTENSIONS:
+            preview = fetch_embedded_preview(bucket, key)
+
+        if preview:
+            preview_offset, thumbnail_data = preview
+        else:
+            preview_offset = None
+
+            # S3からRAWファイル全体を取得（大きなファイルは範囲GETを並列実行）
+            buffer = io.BytesIO()
+            s3_client.download_fileobj(bucket, key, buffer, Config=RAW_DOWNLOAD_CONFIG)
+            raw_data = buffer.getvalue()
+
+            # RAWファイルからサムネイルを抽出
+            thumbnail_data = process_raw_file(raw_data, extension)
 
         # サムネイルを最適化
         optimized_thumbnail = optimize_thumbnail(thumbnail_data)
 
+        metadata = {
+            'source-key': key,
+            'processing-date': datetime.now().isoformat()
+        }
+
+        # 範囲取得したプレビューを変換せずに使う場合は、S3内でコピーして再アップロードを省く
+        if preview_offset is not None and optimized_thumbnail is thumbnail_data:
+            try:
+                logger.info(f"サムネイルをサーバー側コピーで保存: {bucket}/{thumbnail_key}")
+                copy_preview_to_thumbnail(bucket, key, thumbnail_key, preview_offset, len(thumbnail_data), metadata)
+                logger.info(f"サムネイル処理完了: {thumbnail_key}")
+                return {
+                    'statusCode': 200,
+                    'body': f"Successfully processed {filename} and created thumbnail at {thumbnail_key}"
+                }
+            except Exception as e:
+                logger.warning(f"サーバー側コピーエラー（アップロードで続行）: {e}")
+
         # サムネイルをS3にアップロード
         logger.info(f"サムネイルアップロード開始: {bucket}/{thumbnail_key}")
         s3_client.put_object(
@@ -305,10 +847,7 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             Key=thumbnail_key,
             Body=optimized_thumbnail,
             ContentType='image/jpeg',
-            Metadata={
-                'source-key': key,
-                'processing-date': datetime.now().isoformat()
-            }
+            Metadata=metadata
         )
 
         logger.info(f"サムネイル処理完了: {thumbnail_key}")
@@ -318,6 +857,43 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': f"Successfully processed {filename} and created thumbnail at {thumbnail_key}"
         }
 
+    except Exception as e:
+        logger.error(f"レコード処理エラー: {e}")
+
+        return {
+            'statusCode': 500,
+            'body': f"Error processing file: {str(e)}"
+        }
+
+def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """Lambda関数ハンドラー"""
+    # ログ出力が無効な場合はイベントのJSON変換自体を行わない
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("S3イベント受信: %s", json.dumps(event))
+
+    try:
+        records = event['Records']
+        if not records:
+            return {
+                'statusCode': 200,
+                'body': "No records"
+            }
+
+        # 各レコードを並列に処理し、S3のI/O待ちと画像処理を重ねる
+        with ThreadPoolExecutor(max_workers=min(MAX_RECORD_WORKERS, len(records))) as executor:
+            results = list(executor.map(process_record, records))
+
+        # 1件の場合はそのレコードの結果をそのまま返す
+        if len(results) == 1:
+            return results[0]
+
+        # 複数件の場合は全件同じステータスならそのステータス、混在していれば207で結果一覧を返す
+        status_codes = {result['statusCode'] for result in results}
+        return {
+            'statusCode': status_codes.pop() if len(status_codes) == 1 else 207,
+            'body': json.dumps([result['body'] for result in results])
+        }
+
     except Exception as e:
         logger.error(f"Lambda処理エラー: {e}")
 